@@ -0,0 +1,150 @@
+'''
+Array-backed OKT and student-model datasets.
+
+make_pytorch_dataset builds lists of per-sample dicts. Every dict, string and array in them is a
+Python object with a reference count, so a forked DataLoader worker that reads a sample writes to
+the page holding the object and the page gets copied; over an epoch each worker ends up with its
+own copy of the dataset. The datasets here keep all samples in a few flat numpy arrays (integer
+handles, offsets + byte/token buffers, embedding matrices) and only build the sample dict on
+access, so the workers keep sharing the parent's pages. __getitem__ returns the same keys as the
+list datasets, so the collate functions, samplers and generate_code work on either.
+'''
+import numpy as np
+import torch
+
+from dataset_store import pack_text, unpack_text
+
+
+def _stack_rows(rows):
+    # rows may be reduced-precision tensors (see dataset_store.cast_embedding_columns)
+    if len(rows) == 0: # an empty split
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([np.asarray(row.float() if torch.is_tensor(row) else row, dtype=np.float32) for row in rows])
+
+
+class ProblemTable(object):
+    '''
+    one row per problem, keyed by ProblemID:
+        problem_ids                  : sorted unique ProblemIDs
+        prompts                      : prompt text
+        prompt_embs                  : float32 prompt embeddings [P, 768]
+        kc_vecs                      : float32 KC vectors [P, K], None without use_kc
+        prompt_offsets, prompt_token_ids: pre-tokenized prompts (prompt_proc_func, without the EOS)
+    '''
+    def __init__(self, samples):
+        self.problem_ids, first_idx = np.unique([b['ProblemID'] for b in samples], return_index=True)
+        firsts = [samples[i] for i in first_idx]
+        self.prompts = np.array([b['next_prompt'] for b in firsts])
+        self.prompt_embs = _stack_rows([b['next_prompt_emb'] for b in firsts])
+        self.kc_vecs = _stack_rows([b['next_prompt_kc'] for b in firsts]) \
+                       if len(samples) and np.ndim(samples[0]['next_prompt_kc']) else None
+        self.prompt_token_ids = None
+        if len(samples) and 'input_ids' in samples[0]:
+            prompt_ids = [b['input_ids'][:b['prompt_len']] for b in firsts]
+            self.prompt_offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in prompt_ids])])
+            self.prompt_token_ids = np.concatenate(prompt_ids).astype(np.int32)
+
+    def __len__(self):
+        return len(self.problem_ids)
+
+    def index(self, problem_ids):
+        '''
+        row of each ProblemID
+        '''
+        return np.searchsorted(self.problem_ids, problem_ids)
+
+    def prompt_ids(self, idx):
+        return self.prompt_token_ids[self.prompt_offsets[idx]:self.prompt_offsets[idx+1]]
+
+
+class OKTArrayDataset(torch.utils.data.Dataset):
+    '''
+    OKT samples (see make_pytorch_dataset and pretokenize_okt_dataset) as arrays:
+        students, student_idx    : unique SubjectIDs and the handle of each sample
+        problems, problem_idx    : the ProblemTable with the prompt, its embedding, KC vector and
+                                   tokens, and the row of each sample in it
+        steps, scores            : one entry per sample
+        code_offsets, code_bytes : utf-8 code buffer (see dataset_store.pack_text)
+        code_token_offsets, code_token_ids: flat buffer of the pre-tokenized samples after
+                                   the prompt (EOS + code + EOS), with label_ends
+    '''
+    def __init__(self, samples):
+        self.students, self.student_idx = np.unique([b['SubjectID'] for b in samples], return_inverse=True)
+        self.steps = np.array([b['step'] for b in samples], dtype=np.int64)
+        self.scores = np.array([b['next_Score'] for b in samples])
+
+        self.problems = ProblemTable(samples)
+        self.problem_idx = self.problems.index([b['ProblemID'] for b in samples]).astype(np.int32)
+        # without knowledge components next_prompt_kc is a placeholder 0
+        self.kc_placeholder = samples[0]['next_prompt_kc'] if len(samples) and self.problems.kc_vecs is None else 0
+
+        self.code_offsets, self.code_bytes = pack_text([b['next_code'] for b in samples])
+
+        self.code_token_ids = None
+        if self.problems.prompt_token_ids is not None:
+            code_ids = [b['input_ids'][b['prompt_len']:] for b in samples]
+            self.code_token_offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in code_ids])])
+            self.code_token_ids = np.concatenate(code_ids).astype(np.int32)
+            self.label_ends = np.array([b['label_end'] for b in samples], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, idx):
+        problem = self.problem_idx[idx]
+        sample = {
+            'SubjectID': str(self.students[self.student_idx[idx]]),
+            'ProblemID': self.problems.problem_ids[problem],
+            'step': self.steps[idx],
+            'next_Score': self.scores[idx],
+            'next_prompt': str(self.problems.prompts[problem]),
+            'next_prompt_emb': self.problems.prompt_embs[problem],
+            'next_prompt_kc': self.problems.kc_vecs[problem] if self.problems.kc_vecs is not None else self.kc_placeholder,
+            'next_code': unpack_text(self.code_offsets, self.code_bytes, idx),
+        }
+        if self.code_token_ids is not None:
+            prompt_ids = self.problems.prompt_ids(problem)
+            code_ids = self.code_token_ids[self.code_token_offsets[idx]:self.code_token_offsets[idx+1]]
+            sample['input_ids'] = np.concatenate([prompt_ids, code_ids])
+            sample['prompt_len'] = len(prompt_ids)
+            sample['label_end'] = int(self.label_ends[idx])
+        return sample
+
+    def token_lengths(self):
+        '''
+        length of every pre-tokenized sample, for the length-aware batch samplers
+        '''
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.code_token_ids is None:
+            raise ValueError('token lengths need pre-tokenized samples, see pretokenize_okt_dataset')
+        return np.diff(self.problems.prompt_offsets)[self.problem_idx] + np.diff(self.code_token_offsets)
+
+
+class StudentArrayDataset(torch.utils.data.Dataset):
+    '''
+    student-model samples (one per student, see make_pytorch_dataset) packed back to back:
+    Score [N], prompt-embedding [N, 768], input [N, 968] and ProblemID [N] over all responses,
+    with student i at rows offsets[i]:offsets[i+1]. samples hold tensor views of those rows.
+    '''
+    def __init__(self, samples):
+        self.students = np.array([b['SubjectID'] for b in samples])
+        self.offsets = np.concatenate([[0], np.cumsum([len(b['Score']) for b in samples])]).astype(np.int64)
+        self.problem_ids = np.concatenate([np.asarray(b['ProblemID_seq'], dtype=np.int64) for b in samples]) \
+                           if len(samples) else np.zeros(0, dtype=np.int64)
+        self.scores = torch.cat([b['Score'] for b in samples]) if len(samples) else torch.zeros(0)
+        self.prompt_embs = torch.cat([b['prompt-embedding'] for b in samples]) if len(samples) else torch.zeros(0)
+        self.inputs = torch.cat([b['input'] for b in samples]) if len(samples) else torch.zeros(0)
+
+    def __len__(self):
+        return len(self.students)
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx+1]
+        return {
+            'SubjectID': str(self.students[idx]),
+            'ProblemID_seq': self.problem_ids[start:end].tolist(),
+            'Score': self.scores[start:end],
+            'prompt-embedding': self.prompt_embs[start:end],
+            'input': self.inputs[start:end],
+        }
@@ -0,0 +1,1074 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the data pipeline and training hot paths.
+
+Each benchmark runs on synthetic data shaped like the CSEDM dataset, so it can be
+run without downloading data/dataset.pkl, e.g.
+
+    python benchmark.py split_records --rows 40000 1000000 10000000
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from munch import Munch
+from sklearn.metrics import roc_auc_score, jaccard_score
+
+from data_loader import split_student_records, read_data, make_pytorch_dataset, LengthBucketBatchSampler, StudentGroupedBatchSampler, \
+    TokenBudgetBatchSampler, CollateForOKT, CollateForLSTM, pretokenize_okt_dataset
+from utils import prompt_proc_func, code_proc_func
+from dataset_store import convert_pickle_to_columnar, load_columnar_dataset, EMBEDDING_COLUMNS
+from array_dataset import OKTArrayDataset, StudentArrayDataset
+from trainer import KnowledgeStateTable, pad_lstm_inputs, init_lstm_hidden, lstm_knowledge_states, run_lstm, \
+    combine_knowledge_states, kc_similarity, ExpDecayKnowledgeStateTable, CodeEmbeddingBank, decay_knowledge_states, \
+    autocast_context, make_grad_scaler, backward, step_optimizers, accumulation_window
+
+
+def make_synthetic_records(n_rows, mean_len=162, seed=0):
+    """
+    Build a dataframe of n_rows submissions grouped by student, with per-student
+    record lengths drawn around mean_len (CSEDM averages ~162 submissions per student).
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 2 * mean_len, size=2 * (n_rows // mean_len) + 10)
+    lengths = lengths[:np.searchsorted(np.cumsum(lengths), n_rows) + 1]
+    student_idx = np.repeat(np.arange(len(lengths)), lengths)[:n_rows]
+    subject_ids = np.char.add('s', student_idx.astype(str)).astype(object)
+    return pd.DataFrame({
+        'SubjectID': subject_ids,
+        'ProblemID': rng.integers(1, 237, size=n_rows),
+    })
+
+
+def make_synthetic_dataset(n_rows, mean_len=162, n_problems=50, n_distinct_codes=None, seed=0):
+    """
+    Build a dataframe with the columns of data/dataset.pkl that training reads:
+    768-d prompt embeddings, 200-d code embeddings and the 968-d lstm input (as tensors).
+    With n_distinct_codes set, code embeddings are drawn from a shared pool so that
+    millions of rows fit in memory (only useful where values are not copied).
+    """
+    rng = np.random.default_rng(seed)
+    dataset = make_synthetic_records(n_rows, mean_len=mean_len, seed=seed)
+    problem_ids = rng.choice(np.arange(1, 237), size=n_problems, replace=False)
+    problem_idx = rng.integers(0, n_problems, size=n_rows)
+    prompt_embs = rng.standard_normal((n_problems, 768)).astype(np.float32)
+    code_embs = rng.standard_normal((n_distinct_codes or n_rows, 200)).astype(np.float32)
+    if n_distinct_codes:
+        code_embs = code_embs[rng.integers(0, n_distinct_codes, size=n_rows)]
+    dataset['ProblemID'] = problem_ids[problem_idx]
+    dataset['CodeStateID'] = ['c{}'.format(i) for i in range(n_rows)]
+    dataset['Score_x'] = rng.random(n_rows)
+    dataset['Score_y'] = rng.integers(0, 3, size=n_rows)
+    dataset['prompt'] = ['Given 2 ints, a and b, return problem {} ...'.format(p) for p in dataset['ProblemID']]
+    dataset['Code'] = ['public int f{}(int a, int b)\n{{\n    return a + b;\n}}'.format(i) for i in range(n_rows)]
+    if n_distinct_codes:
+        prompt_rows = list(prompt_embs)
+        dataset['prompt-embedding'] = [prompt_rows[i] for i in problem_idx]
+        dataset['embedding'] = [code_embs[0]] * n_rows
+        dataset['input'] = [torch.zeros(968)] * n_rows
+    else:
+        dataset['prompt-embedding'] = list(prompt_embs[problem_idx])
+        dataset['embedding'] = list(code_embs)
+        dataset['input'] = [torch.from_numpy(row) for row in np.concatenate([prompt_embs[problem_idx], code_embs], axis=1)]
+    return dataset
+
+
+def make_okt_configs(data_path, **kwargs):
+    """Default OKT data configs (as in configs_okt.yaml), overridable by kwargs."""
+    configs = Munch(data_path=data_path, data_for='okt', testing=False, use_kc=False, test_size=0.2,
+                    max_len=200, label_type='binary', first_ast_convertible=True, split_method='student',
+                    seed=1, kt_model='lstm', combine_method='weight')
+    configs.update(kwargs)
+    return configs
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def _split_student_records_loop(dataset, max_len):
+    """Per-row reference implementation, kept for comparison."""
+    prev_subject_id = 0
+    subjectid_appedix = []
+    timesteps = []
+    for i in range(len(dataset)):
+        if prev_subject_id != dataset.iloc[i].SubjectID:
+            prev_subject_id = dataset.iloc[i].SubjectID
+            accumulated = 0
+            id_appendix = 1
+        else:
+            accumulated += 1
+            if accumulated >= max_len:
+                id_appendix += 1
+                accumulated = 0
+        timesteps.append(accumulated)
+        subjectid_appedix.append(id_appendix)
+    dataset['timestep'] = timesteps
+    dataset['SubjectID_appendix'] = subjectid_appedix
+    dataset['SubjectID'] = [dataset.iloc[i].SubjectID + \
+                '_{}'.format(dataset.iloc[i].SubjectID_appendix) for i in range(len(dataset))]
+    return dataset
+
+
+def bench_split_records(args):
+    print('{:>10} {:>14} {:>14} {:>10}'.format('rows', 'loop (s)', 'columnar (s)', 'speedup'))
+    for n_rows in args.rows:
+        records = make_synthetic_records(n_rows)
+        columnar, t_columnar = timed(split_student_records, records.copy(), args.max_len)
+
+        # the loop is far too slow at 10M rows; time a prefix and extrapolate linearly
+        n_loop = min(n_rows, args.loop_max_rows)
+        loop, t_loop = timed(_split_student_records_loop, records.iloc[:n_loop].copy(), args.max_len)
+        expected = split_student_records(records.iloc[:n_loop].copy(), args.max_len)
+        pd.testing.assert_frame_equal(loop, expected)
+        t_loop = t_loop * n_rows / n_loop
+        note = '' if n_loop == n_rows else ' (extrapolated from {} rows)'.format(n_loop)
+        print('{:>10} {:>14.3f} {:>14.3f} {:>9.1f}x{}'.format(
+            n_rows, t_loop, t_columnar, t_loop / t_columnar, note))
+
+
+def _make_pytorch_dataset_loop(dataset_split, dataset_full, configs, students):
+    """Per-student filter + iloc reference implementation of the OKT branch, kept for comparison."""
+    okt_dataset = []
+    for student in students:
+        subset = dataset_split[dataset_split.SubjectID==student]
+        for t in range(len(subset)):
+            okt_dataset.append({
+                'SubjectID': student,
+                'ProblemID': subset.iloc[t].ProblemID,
+                'step': subset.iloc[t].timestep-1, 
+                'next_Score': subset.iloc[t].Score,
+                'next_prompt': subset.iloc[t].prompt,
+                'next_prompt_emb': subset.iloc[t]['prompt-embedding'],
+                'next_prompt_kc': subset.iloc[t].kc_vec,
+                'next_code': subset.iloc[t].Code,
+            })
+    lstm_dataset = {}
+    for student in students:
+        lstm_dataset[student] = dataset_full[dataset_full.SubjectID==student].input.tolist()
+    return okt_dataset, lstm_dataset
+
+
+def _same(a, b):
+    return type(a) == type(b) and (a is b or np.array_equal(np.asarray(a), np.asarray(b)))
+
+
+def bench_make_dataset(args):
+    print('{:>10} {:>10} {:>14} {:>14} {:>10}'.format('students', 'rows', 'loop (s)', 'indexed (s)', 'speedup'))
+    for n_students in args.students:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            make_synthetic_dataset(n_students * args.mean_len, mean_len=args.mean_len,
+                                   n_distinct_codes=1000).to_pickle(os.path.join(tmp_dir, 'dataset.pkl'))
+            configs = make_okt_configs(tmp_dir)
+            trainset, _, _, dataset = read_data(configs)
+        (okt_dataset, lstm_dataset), t_indexed = timed(make_pytorch_dataset, trainset, dataset, None, configs)
+
+        # the per-student loop is quadratic; time a subset of the students and extrapolate linearly
+        students = trainset.SubjectID.unique()
+        n_loop = min(len(students), args.loop_max_students)
+        (okt_loop, lstm_loop), t_loop = timed(_make_pytorch_dataset_loop, trainset, dataset, configs, students[:n_loop])
+        assert len(okt_loop) == sum(s['SubjectID'] in set(students[:n_loop]) for s in okt_dataset)
+        for a, b in zip(okt_loop, okt_dataset):
+            assert a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a)
+        for student in lstm_loop:
+            assert all(_same(a, b) for a, b in zip(lstm_loop[student], lstm_dataset[student]))
+        t_loop = t_loop * len(students) / n_loop
+        note = '' if n_loop == len(students) else ' (extrapolated from {} students)'.format(n_loop)
+        print('{:>10} {:>10} {:>14.3f} {:>14.3f} {:>9.1f}x{}'.format(
+            n_students, len(dataset), t_loop, t_indexed, t_loop / t_indexed, note))
+
+
+def make_synthetic_token_lengths(n_samples, seed=0):
+    """Generator input lengths (prompt + code tokens), long-tailed like student programs, capped at 1024."""
+    rng = np.random.default_rng(seed)
+    return np.minimum(40 + rng.lognormal(mean=4.5, sigma=0.7, size=n_samples).astype(int), 1024)
+
+
+def padding_efficiency(lengths, batches):
+    real = sum(lengths[b].sum() for b in batches)
+    total = sum(lengths[b].max() * len(b) for b in batches)
+    return real / total
+
+
+def bench_batch_sampler(args):
+    lengths = make_synthetic_token_lengths(args.samples)
+    random_batches = list(torch.utils.data.BatchSampler(
+        torch.utils.data.RandomSampler(range(len(lengths))), args.batch_size, drop_last=False))
+    print('random batches           : padding efficiency {:.3f}'.format(padding_efficiency(lengths, random_batches)))
+    for multiplier in args.bucket_size_multiplier:
+        sampler = LengthBucketBatchSampler(lengths, args.batch_size, shuffle=True, bucket_size_multiplier=multiplier)
+        epochs = [list(sampler) for _ in range(2)]
+        assert len(epochs[0]) == len(sampler) and sorted(sum(epochs[0], [])) == list(range(len(lengths)))
+        print('length buckets (x{:<4})   : padding efficiency {:.3f}, batches differ across epochs: {}'.format(
+            multiplier, padding_efficiency(lengths, epochs[0]), epochs[0] != epochs[1]))
+    for max_tokens in args.max_tokens_per_batch:
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens, shuffle=True,
+                                          bucket_size=args.batch_size*args.bucket_size_multiplier[-1])
+        n_batches = len(sampler)
+        batches = list(sampler)
+        assert len(batches) == n_batches and sorted(sum(batches, [])) == list(range(len(lengths)))
+        padded = [len(batch) * lengths[batch].max() for batch in batches]
+        print('token budget ({:<6})    : padding efficiency {:.3f}, {} batches of {:.1f} samples on average, '
+              'largest padded batch {} tokens'.format(max_tokens, padding_efficiency(lengths, batches), n_batches,
+                                                     len(lengths) / n_batches, max(padded)))
+
+
+def make_synthetic_okt_rows(n_samples, seed=0):
+    """OKT samples as made by make_pytorch_dataset, with code of 3 to ~120 lines."""
+    rng = np.random.default_rng(seed)
+    n_lines = np.minimum(3 + rng.lognormal(mean=2.0, sigma=0.8, size=n_samples).astype(int), 120)
+    return [{'SubjectID': 's{}_1'.format(i // 20), 'ProblemID': i % 50, 'step': np.int64(i % 20), 'next_Score': float(i % 2),
+             'next_prompt': 'Given 2 ints, a and b, return problem {} ...'.format(i % 50),
+             'next_prompt_emb': rng.standard_normal(768).astype(np.float32), 'next_prompt_kc': None,
+             'next_code': 'public int f(int a, int b)\n{\n' + '    a = a + b;\n' * n + '    return a;\n}'}
+            for i, n in enumerate(n_lines)]
+
+
+def _collate_okt_loop(collate, batch):
+    """CollateForOKT.__call__ before vectorization: EOS locations and labels row by row."""
+    tokenizer = collate.tokenizer
+    generator_inputs_raw = [prompt_proc_func(b['next_prompt']) + code_proc_func(b['next_code'], tokenizer) for b in batch]
+    generator_inputs = tokenizer(generator_inputs_raw, return_tensors='pt', padding=True, truncation=True)
+    generator_inputs_ids, attention_mask = generator_inputs['input_ids'], generator_inputs['attention_mask']
+    eos_id_locations = torch.where(generator_inputs_ids==tokenizer.eos_token_id)
+    first_eos_id_location = torch.zeros(generator_inputs_ids.shape[0]).long()
+    second_eos_id_location = torch.zeros(generator_inputs_ids.shape[0]).long()
+    for idx in range(generator_inputs_ids.shape[0]):
+        eos_idx = eos_id_locations[1][eos_id_locations[0]==idx]
+        first_eos_id_location[idx] = eos_idx[0]
+        second_eos_id_location[idx] = eos_idx[1] if len(eos_idx) > 1 else len(generator_inputs_ids[idx])-1
+    prompt_id_lens = [len(generator_inputs_ids[i][:first_eos_id_location[i]]) for i in range(len(first_eos_id_location))]
+    labels = torch.ones_like(generator_inputs_ids) * -100.
+    for idx in range(labels.shape[0]):
+        labels[idx, first_eos_id_location[idx]+1:second_eos_id_location[idx]+1] = generator_inputs_ids[idx, first_eos_id_location[idx]+1:second_eos_id_location[idx]+1]
+    return collate.collate_rest(batch, generator_inputs_ids, attention_mask, labels.long(), prompt_id_lens)
+
+
+def _same_batch(a, b):
+    return len(a) == len(b) and all(
+        torch.equal(x, y) and x.dtype == y.dtype if torch.is_tensor(x) else x == y for x, y in zip(a, b))
+
+
+def samples_per_sec(collate_fn, batches, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            collate_fn(batch)
+    return repeat * sum(len(batch) for batch in batches) / (time.perf_counter() - start)
+
+
+def bench_collate(args):
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    if args.pad_token == 'pad':
+        tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+    else:
+        tokenizer.pad_token = tokenizer.eos_token
+    configs = Munch(testing=False, use_kc=False, use_classifier=True)
+    collate = CollateForOKT(tokenizer=tokenizer, configs=configs)
+    rows = make_synthetic_okt_rows(args.samples)
+    pretokenized = pretokenize_okt_dataset([dict(row) for row in rows], tokenizer)
+
+    print('{:>6} {:>16} {:>18} {:>20}'.format('batch', 'loop (samp/s)', 'vectorized (samp/s)', 'pre-tokenized (samp/s)'))
+    for batch_size in args.batch_size:
+        batches = [rows[i:i+batch_size] for i in range(0, len(rows), batch_size)]
+        pretokenized_batches = [pretokenized[i:i+batch_size] for i in range(0, len(rows), batch_size)]
+        for batch, pretokenized_batch in zip(batches, pretokenized_batches):
+            reference = _collate_okt_loop(collate, batch)
+            assert _same_batch(reference, collate(batch)) and _same_batch(reference, collate(pretokenized_batch))
+        print('{:>6} {:>16.0f} {:>18.0f} {:>20.0f}'.format(
+            batch_size, samples_per_sec(lambda b: _collate_okt_loop(collate, b), batches, args.repeat),
+            samples_per_sec(collate, batches, args.repeat), samples_per_sec(collate, pretokenized_batches, args.repeat)))
+
+
+def _collate_lstm_lists(batch):
+    """CollateForLSTM before per-student tensors: lists of rows, zero rows per missing step, double stack."""
+    scores = [b['Score'] for b in batch]
+    max_len = max(len(i) for i in scores)
+    padded_scores = torch.tensor([i + [-100]*(max_len-len(i)) for i in scores]).float().t()
+    padded = []
+    for key in ['input', 'prompt-embedding']:
+        rows = [b[key] + [torch.zeros(b[key][0].shape[0])]*(max_len - len(b[key])) for b in batch]
+        padded.append(torch.stack([torch.stack(x, dim=0) for x in rows], dim=1).float())
+    return padded[0], padded[1], padded_scores
+
+
+def batches_per_sec(loader, repeat):
+    start = time.perf_counter()
+    n_batches = 0
+    for _ in range(repeat):
+        for _ in loader:
+            n_batches += 1
+    return n_batches / (time.perf_counter() - start)
+
+
+def bench_lstm_collate(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        make_synthetic_dataset(args.students * args.mean_len, mean_len=args.mean_len).to_pickle(
+            os.path.join(tmp_dir, 'dataset.pkl'))
+        configs = make_okt_configs(tmp_dir, data_for='lstm', batch_size=args.batch_size)
+        train_students, _, _, dataset = read_data(configs)
+    tensor_dataset = make_pytorch_dataset(None, dataset, train_students, configs)
+    # the per-student lists of row tensors that the dataset held before
+    list_dataset = [{'Score': b['Score'].tolist(), 'input': list(b['input'].unbind(0)),
+                     'prompt-embedding': list(b['prompt-embedding'].unbind(0))} for b in tensor_dataset]
+
+    list_loader = torch.utils.data.DataLoader(list_dataset, batch_size=args.batch_size, collate_fn=_collate_lstm_lists)
+    tensor_loader = torch.utils.data.DataLoader(tensor_dataset, batch_size=args.batch_size, collate_fn=CollateForLSTM(None))
+    for a, b in zip(list_loader, tensor_loader):
+        assert all(torch.equal(x, y) for x, y in zip(a, b))
+    t_lists, t_tensors = batches_per_sec(list_loader, args.repeat), batches_per_sec(tensor_loader, args.repeat)
+    print('{} students, batch size {}: lists {:.1f} batches/s, per-student tensors {:.1f} batches/s ({:.1f}x)'.format(
+        len(tensor_dataset), args.batch_size, t_lists, t_tensors, t_tensors / t_lists))
+
+
+def private_memory_mb():
+    """Pages of this process that are not shared with any other (copied-on-write ones included)."""
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':', 1) for line in f if line.startswith('Private_'))
+    return sum(int(value.split()[0]) for value in fields.values()) / 1024
+
+
+class CollateWithMemory(object):
+    """Collate pre-tokenized OKT samples and report the worker's private memory with every batch."""
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, batch):
+        return self.collate(batch), torch.utils.data.get_worker_info().id, private_memory_mb()
+
+
+def make_synthetic_pretokenized_rows(n_samples, seed=0):
+    """make_synthetic_okt_rows with random token ids in place of pretokenize_okt_dataset."""
+    rng = np.random.default_rng(seed)
+    rows = make_synthetic_okt_rows(n_samples, seed=seed)
+    for row, length in zip(rows, make_synthetic_token_lengths(n_samples, seed=seed)):
+        row['input_ids'] = rng.integers(0, 50257, size=length).astype(np.int32)
+        row['prompt_len'] = int(rng.integers(10, 30))
+        row['label_end'] = int(length) - 1
+    return rows
+
+
+def bench_worker_rss(args):
+    configs = Munch(testing=False, use_kc=False, use_classifier=True, batch_size=args.batch_size, data_for='okt')
+    collate = CollateWithMemory(CollateForOKT(tokenizer=Munch(pad_token_id=50257), configs=configs))
+    samples = make_synthetic_pretokenized_rows(args.samples)
+    datasets = {'list of dicts': samples, 'array-backed': OKTArrayDataset(samples)}
+    print('{} samples, {} workers, private memory per worker (MB)'.format(args.samples, args.workers))
+    print('{:>14} {:>10} {:>14} {:>10}'.format('dataset', 'start', 'end of epoch', 'growth'))
+    for name, dataset in datasets.items():
+        loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                             collate_fn=collate, num_workers=args.workers)
+        first, last = {}, {}
+        for _, worker_id, memory in loader:
+            first.setdefault(worker_id, memory)
+            last[worker_id] = memory
+        growth = [last[w] - first[w] for w in first]
+        print('{:>14} {:>10.1f} {:>14.1f} {:>10.1f}'.format(
+            name, np.mean(list(first.values())), np.mean(list(last.values())), np.mean(growth)))
+
+
+def student_model_auc(lstm, classifier, loader):
+    """AUC of the student model on a loader of CollateForLSTM batches, as in lstm_step (on CPU)."""
+    logits, scores = [], []
+    with torch.no_grad():
+        for inputs, prompt_embs, batch_scores in loader:
+            hidden = torch.zeros(1, inputs.shape[1], lstm.hidden_size)
+            out, _ = lstm(inputs[:-1], (hidden, hidden))
+            batch_logits = classifier(torch.cat((out, prompt_embs[:-1]), dim=-1)).squeeze(-1)
+            mask = batch_scores[1:] != -100
+            logits.append(batch_logits[mask])
+            scores.append(batch_scores[1:][mask])
+    return roc_auc_score(torch.cat(scores).numpy(), torch.cat(logits).numpy())
+
+
+def bench_embedding_dtype(args):
+    torch.manual_seed(0)
+    dataset = make_synthetic_dataset(args.students * args.mean_len, mean_len=args.mean_len)
+    # correctness that depends on the embeddings the classifier sees for it (lstm_step pairs the
+    # response at t+1 with the inputs at t), so that the AUC means something
+    signal = np.stack(dataset['prompt-embedding'])[:, :8].sum(1) + np.stack(dataset['embedding'])[:, :8].sum(1)
+    signal = pd.Series(signal).groupby(dataset['SubjectID'].to_numpy()).shift(1).fillna(0).to_numpy()
+    dataset['Score_y'] = np.where(signal + np.random.default_rng(0).normal(size=len(dataset)) > 0, 2, 0)
+
+    data = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset.to_pickle(os.path.join(tmp_dir, 'dataset.pkl'))
+        for dtype in ['float32', 'float16', 'bfloat16']:
+            # read_data loads the columnar copy stored in dtype
+            columnar_dir = os.path.join(tmp_dir, dtype, 'dataset_columnar')
+            convert_pickle_to_columnar(os.path.join(tmp_dir, 'dataset.pkl'), columnar_dir, dtype=dtype)
+            disk = sum(os.path.getsize(os.path.join(columnar_dir, col + '.npy')) for col in EMBEDDING_COLUMNS)
+            configs = make_okt_configs(os.path.join(tmp_dir, dtype), data_for='lstm', embedding_dtype=dtype,
+                                       first_ast_convertible=False)
+            train_students, _, test_students, full = read_data(configs)
+            data[dtype] = (StudentArrayDataset(make_pytorch_dataset(None, full, train_students, configs)),
+                           StudentArrayDataset(make_pytorch_dataset(None, full, test_students, configs)), disk)
+
+    # train one model on every storage precision, with the same initialization and batch order, 
+    # and evaluate it on the same precision; only the embeddings differ
+    print('{:>9} {:>12} {:>12} {:>10} {:>10}'.format('dtype', 'RAM (MB)', 'disk (MB)', 'test AUC', 'delta'))
+    auc = {}
+    for dtype, (train_set, test_set, disk) in data.items():
+        torch.manual_seed(0)
+        lstm, classifier = torch.nn.LSTM(968, args.hidden_dim), torch.nn.Sequential(
+            torch.nn.Linear(args.hidden_dim + 768, 50), torch.nn.ReLU(), torch.nn.Linear(50, 1))
+        optimizer = torch.optim.Adam(list(lstm.parameters()) + list(classifier.parameters()), lr=1e-3)
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=32, shuffle=True, collate_fn=CollateForLSTM(None))
+        for _ in range(args.epochs):
+            for inputs, prompt_embs, scores in train_loader:
+                hidden = torch.zeros(1, inputs.shape[1], args.hidden_dim)
+                out, _ = lstm(inputs[:-1], (hidden, hidden))
+                logits = classifier(torch.cat((out, prompt_embs[:-1]), dim=-1)).squeeze(-1)
+                mask = scores[1:] != -100
+                loss = torch.nn.functional.binary_cross_entropy_with_logits(logits[mask], scores[1:][mask])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+        ram = sum(t.element_size() * t.nelement() for t in [train_set.inputs, train_set.prompt_embs, test_set.inputs, test_set.prompt_embs])
+        test_loader = torch.utils.data.DataLoader(test_set, batch_size=32, collate_fn=CollateForLSTM(None))
+        auc[dtype] = student_model_auc(lstm, classifier, test_loader)
+        print('{:>9} {:>12.1f} {:>12.1f} {:>10.4f} {:>10.4f}'.format(dtype, ram / 2**20, disk / 2**20, auc[dtype], auc[dtype] - auc['float32']))
+        assert abs(auc[dtype] - auc['float32']) < args.auc_tolerance, dtype
+
+    # a store in reduced precision read with embedding_dtype float32 is upcast on load
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset.to_pickle(os.path.join(tmp_dir, 'dataset.pkl'))
+        convert_pickle_to_columnar(os.path.join(tmp_dir, 'dataset.pkl'), os.path.join(tmp_dir, 'dataset_columnar'), dtype='float16')
+        _, _, _, full = read_data(make_okt_configs(tmp_dir, data_for='lstm', embedding_dtype='float32', first_ast_convertible=False))
+        assert all(torch.as_tensor(full[col].iloc[0]).dtype == torch.float32 for col in EMBEDDING_COLUMNS)
+
+
+def make_synthetic_lstm_inputs(n_students, mean_len, seed=0):
+    """lstm_inputs as made by make_pytorch_dataset (kt_model lstm), and the OKT samples (student, step) on them."""
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.poisson(mean_len, n_students), 2, 200)
+    lstm_inputs = {'s{}'.format(i): list(torch.randn(n, 968).unbind()) for i, n in enumerate(lengths)}
+    # one OKT sample per response after the first
+    samples = [(s, t) for s in lstm_inputs for t in range(len(lstm_inputs[s]) - 1)]
+    return lstm_inputs, samples
+
+
+def bench_knowledge_states(args):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    lstm_inputs, samples = make_synthetic_lstm_inputs(args.students, args.mean_len)
+    students = list(lstm_inputs)
+    # random batches as in main_okt.py
+    order = rng.permutation(len(samples))[:args.batches * args.batch_size]
+    batches = [[samples[i] for i in order[j:j+args.batch_size]] for j in range(0, len(order), args.batch_size)]
+    configs = Munch(use_lstm=True, kt_model='lstm', train_lstm=False, lstm_init='zero', lstm_hid_dim=args.hidden_dim)
+    lstm = torch.nn.LSTM(968, args.hidden_dim)
+
+    def per_batch(batch):
+        # get_knowledge_states_for_generator with train_lstm false, on CPU
+        with torch.no_grad():
+            out, _ = lstm(pad_lstm_inputs([lstm_inputs[s] for s, t in batch]), init_lstm_hidden(len(batch), configs, 'cpu'))
+        return out[[t for s, t in batch], list(range(out.shape[1])), :]
+
+    recomputed, t_recompute = timed(lambda: [per_batch(batch) for batch in batches])
+    ks_table, t_build = timed(KnowledgeStateTable, lstm, lstm_inputs, configs, device='cpu')
+    looked_up, t_lookup = timed(lambda: [ks_table([s for s, t in batch], [t for s, t in batch]) for batch in batches])
+    for a, b in zip(recomputed, looked_up):
+        assert torch.allclose(a, b, atol=1e-5)
+
+    n_epoch_batches = len(samples) / args.batch_size
+    print('{} students, {} samples, {} batches of {} timed'.format(len(students), len(samples), len(batches), args.batch_size))
+    print('{:>22} {:>14} {:>16}'.format('', 'ms / batch', 'epoch est. (s)'))
+    print('{:>22} {:>14.2f} {:>16.1f}'.format('lstm per batch', 1000 * t_recompute / len(batches), t_recompute / len(batches) * n_epoch_batches))
+    print('{:>22} {:>14.3f} {:>16.1f}'.format('table lookup', 1000 * t_lookup / len(batches), t_lookup / len(batches) * n_epoch_batches))
+    print('table built once in {:.2f} s, {:.1f} MB'.format(t_build, ks_table.states.element_size() * ks_table.states.nelement() / 2**20))
+
+
+def bench_student_batches(args):
+    torch.manual_seed(0)
+    lstm_inputs, samples = make_synthetic_lstm_inputs(args.students, args.mean_len)
+    student_idx = np.unique([s for s, t in samples], return_inverse=True)[1]
+    configs = Munch(train_lstm=True, lstm_init='zero', lstm_hid_dim=args.hidden_dim, packed_lstm=args.packed_lstm)
+    lstm = torch.nn.LSTM(968, args.hidden_dim)
+
+    # gradient semantics: one pass per student of the batch == one pass per sample
+    batch = samples[:args.batch_size // 2] + samples[len(samples) // 2:][:args.batch_size - args.batch_size // 2]
+    students, timesteps = [s for s, t in batch], [t for s, t in batch]
+    ks, _ = lstm_knowledge_states(lstm, lstm_inputs, students, timesteps, configs, device='cpu')
+    grads = torch.autograd.grad(ks.square().sum(), list(lstm.parameters()))
+    out, _ = lstm(pad_lstm_inputs([lstm_inputs[s] for s in students]), init_lstm_hidden(len(batch), configs, 'cpu'))
+    per_sample_grads = torch.autograd.grad(out[timesteps, list(range(len(batch))), :].square().sum(), list(lstm.parameters()))
+    assert all(torch.allclose(a, b, atol=1e-4) for a, b in zip(grads, per_sample_grads))
+
+    print('{} students, {} samples, batch size {}, forward + backward of {} batches'.format(
+        args.students, len(samples), args.batch_size, args.batches))
+    print('{:>14} {:>18} {:>20} {:>14}'.format('group size', 'students / batch', 'lstm steps / sample', 'ms / batch'))
+    for group_size in args.group_size:
+        # group_size 1 is a uniformly random order, i.e. the default shuffled batches
+        sampler = StudentGroupedBatchSampler(student_idx, args.batch_size, group_size=group_size)
+        batches = [[samples[i] for i in batch] for batch in list(sampler)[:args.batches]]
+        n_students, lstm_steps = 0, 0
+        start = time.perf_counter()
+        for batch in batches:
+            ks, out = lstm_knowledge_states(lstm, lstm_inputs, [s for s, t in batch], [t for s, t in batch], configs, device='cpu')
+            ks.sum().backward()
+            n_students += out.shape[1]
+            lstm_steps += out.shape[0] * out.shape[1]
+        elapsed = time.perf_counter() - start
+        print('{:>14} {:>18.2f} {:>20.1f} {:>14.1f}'.format(
+            group_size, n_students / len(batches), lstm_steps / sum(len(b) for b in batches), 1000 * elapsed / len(batches)))
+
+
+def make_lstm_lengths(distribution, n, mean_len, rng):
+    if distribution == 'poisson':
+        lengths = rng.poisson(mean_len, n)
+    else:
+        # most students with a few responses, a long tail up to max_len
+        lengths = rng.lognormal(np.log(mean_len) - 0.5, 1., n)
+    return np.clip(lengths, 2, 200).astype(np.int64)
+
+
+def bench_packed_lstm(args):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    lstm = torch.nn.LSTM(968, args.hidden_dim)
+    print('{:>10} {:>6} {:>12} {:>14} {:>14} {:>9}'.format('lengths', 'batch', 'real steps', 'padded (ms)', 'packed (ms)', 'speedup'))
+    for distribution in args.distribution:
+        for batch_size in args.batch_size:
+            # student-model batches as in lstm_step: T*B*D inputs and the scores padded with -100
+            batches = []
+            for _ in range(args.batches):
+                lengths = make_lstm_lengths(distribution, batch_size, args.mean_len, rng)
+                scores = torch.full((lengths.max(), batch_size), -100.)
+                for i, length in enumerate(lengths):
+                    scores[:length, i] = 1.
+                inputs = torch.randn(lengths.max(), batch_size, 968) * (scores != -100).unsqueeze(-1)
+                batches.append((inputs[:-1], (scores != -100).sum(0) - 1))
+
+            def run(packed):
+                outs = []
+                for inputs, lengths in batches:
+                    hidden = (torch.zeros(1, inputs.shape[1], args.hidden_dim), torch.zeros(1, inputs.shape[1], args.hidden_dim))
+                    out, _ = run_lstm(lstm, inputs, lengths, hidden, packed=packed)
+                    mask = torch.arange(inputs.shape[0]).unsqueeze(1) < lengths.unsqueeze(0)
+                    out[mask].sum().backward()
+                    outs.append(out[mask].detach())
+                return outs
+
+            padded, t_padded = timed(run, False)
+            packed, t_packed = timed(run, True)
+            # the same states at every real step
+            for a, b in zip(padded, packed):
+                assert torch.allclose(a, b, atol=1e-5)
+            real = sum(int(lengths.sum()) for _, lengths in batches) / sum(inputs.shape[0] * inputs.shape[1] for inputs, _ in batches)
+            print('{:>10} {:>6} {:>12.2f} {:>14.1f} {:>14.1f} {:>8.2f}x'.format(
+                distribution, batch_size, real, 1000 * t_padded / len(batches), 1000 * t_packed / len(batches), t_padded / t_packed))
+
+    # gradients of the lstm match as well
+    inputs, lengths = batches[0]
+    hidden = (torch.zeros(1, inputs.shape[1], args.hidden_dim), torch.zeros(1, inputs.shape[1], args.hidden_dim))
+    mask = torch.arange(inputs.shape[0]).unsqueeze(1) < lengths.unsqueeze(0)
+    padded_grads = torch.autograd.grad(lstm(inputs, hidden)[0][mask].square().sum(), list(lstm.parameters()))
+    packed_grads = torch.autograd.grad(run_lstm(lstm, inputs, lengths, hidden)[0][mask].square().sum(), list(lstm.parameters()))
+    assert all(torch.allclose(a, b, rtol=1e-4, atol=1e-4) for a, b in zip(padded_grads, packed_grads))
+
+
+def _combine_knowledge_states_loop(generator_input_wte, prompt_id_lens, ks, linear, weight, configs, kc_vecs=None):
+    """The per-row loop assemble_generator_input used before combine_knowledge_states."""
+    for i in range(len(prompt_id_lens)):
+        if configs.combine_method == 'add':
+            generator_input_wte[i, :prompt_id_lens[i]] += configs.combine_weight * ks[i]
+        elif configs.combine_method == 'average':
+            generator_input_wte[i, :prompt_id_lens[i]] = (generator_input_wte[i, :prompt_id_lens[i]] + \
+                                                        configs.combine_weight * ks[i]) / 2
+        elif configs.combine_method == 'weight':
+            generator_input_wte[i, :prompt_id_lens[i]] += weight * ks[i]
+        elif configs.combine_method == 'linear':
+            if configs.use_kc:
+                generator_input_wte[i, :prompt_id_lens[i]] += linear( torch.cat((ks[i], kc_vecs[i]), dim=-1) )
+            else:
+                generator_input_wte[i, :prompt_id_lens[i]] += linear(ks[i])
+        elif configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
+            generator_input_wte[i, :prompt_id_lens[i]] += linear(ks[i])
+    return generator_input_wte
+
+
+def bench_inject_ks(args):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    wte = torch.nn.Embedding(1000, 768)
+    variants = {
+        'add': (dict(combine_method='add', use_kc=False), 768, None),
+        'average': (dict(combine_method='average', use_kc=False), 768, None),
+        'weight': (dict(combine_method='weight', use_kc=False), 768, None),
+        'linear': (dict(combine_method='linear', use_kc=False), 768, torch.nn.Linear(768, 768)),
+        'linear+kc': (dict(combine_method='linear', use_kc=True), 768, torch.nn.Linear(768 + 18, 768)),
+        'exp_decay': (dict(combine_method='exp_decay', use_kc=False), 200, torch.nn.Linear(200, 768)),
+    }
+    print('{:>10} {:>6} {:>12} {:>16} {:>9}'.format('method', 'batch', 'loop (ms)', 'vectorized (ms)', 'speedup'))
+    for name, (options, ks_dim, linear) in variants.items():
+        configs = Munch(combine_weight=1, **options)
+        weight = torch.nn.Parameter(torch.tensor(1.))
+        params = [wte.weight, weight] + (list(linear.parameters()) if linear is not None else [])
+        for batch_size in args.batch_size:
+            ids = torch.from_numpy(rng.integers(1000, size=(batch_size, args.seq_len)))
+            prompt_id_lens = rng.integers(20, 120, size=batch_size).tolist()
+            ks = torch.randn(batch_size, ks_dim, requires_grad=True)
+            kc_vecs = torch.from_numpy(rng.integers(2, size=(batch_size, 18))).float()
+
+            def step(combine):
+                # forward + backward of the combination, as in generator_step
+                combined = combine(wte(ids), prompt_id_lens, ks, linear, weight, configs, kc_vecs=kc_vecs)
+                grads = torch.autograd.grad(combined.square().sum(), [ks] + params, allow_unused=True)
+                return combined.detach(), grads
+
+            (loop_out, loop_grads), t_loop = timed(lambda: [step(_combine_knowledge_states_loop) for _ in range(args.repeat)][-1])
+            (vec_out, vec_grads), t_vec = timed(lambda: [step(combine_knowledge_states) for _ in range(args.repeat)][-1])
+            assert torch.allclose(loop_out, vec_out, atol=1e-5), name
+            for a, b in zip(loop_grads, vec_grads):
+                # the same up to the float summation order
+                assert (a is None and b is None) or (a - b).norm() <= 1e-5 * a.norm(), name
+            print('{:>10} {:>6} {:>12.2f} {:>16.2f} {:>8.2f}x'.format(
+                name, batch_size, 1000 * t_loop / args.repeat, 1000 * t_vec / args.repeat, t_loop / t_vec))
+
+
+def make_synthetic_decay_inputs(n_students, mean_len, n_problems=50, seed=0):
+    """lstm_inputs as made by make_pytorch_dataset for the decay combine methods, and the OKT samples on them."""
+    rng = np.random.default_rng(seed)
+    # every problem covers a few of the 18 KCs
+    problem_kcs = (rng.random((n_problems, 18)) < 0.15).astype(np.int64)
+    lstm_inputs = {}
+    for i, length in enumerate(np.clip(rng.poisson(mean_len, n_students), 2, 200)):
+        lstm_inputs['s{}'.format(i)] = {'code_emb': list(rng.standard_normal((length, 200)).astype(np.float32)),
+                                        'prompt_kc': list(problem_kcs[rng.integers(n_problems, size=length)])}
+    samples = [(s, t) for s in lstm_inputs for t in range(len(lstm_inputs[s]['code_emb']) - 1)]
+    return lstm_inputs, samples
+
+
+def _kc_weights_loop(lstm_inputs, students, timesteps):
+    """The kc_sim_decay weights of get_knowledge_states_for_generator before kc_similarity."""
+    kc_weights = []
+    prompt_kc = [lstm_inputs[s]['prompt_kc'] for s in students]
+    for b in range(len(timesteps)):
+        w = torch.tensor([jaccard_score(prompt_kc[b][i], prompt_kc[b][timesteps[b]+1]) for i in range(timesteps[b]+1)])
+        w = w / w.sum() if w.sum() != 0 else torch.zeros_like(w)
+        kc_weights.append(w)
+    return kc_weights
+
+
+def _kc_weights(lstm_inputs, students, timesteps):
+    kc_weights = []
+    for b in range(len(timesteps)):
+        w = torch.from_numpy(kc_similarity(lstm_inputs, students[b])[timesteps[b]+1, :timesteps[b]+1])
+        w = w / w.sum() if w.sum() != 0 else torch.zeros_like(w)
+        kc_weights.append(w)
+    return kc_weights
+
+
+def bench_kc_weights(args):
+    import warnings
+    warnings.filterwarnings('ignore') # jaccard_score warns on pairs without any KC
+    rng = np.random.default_rng(0)
+    lstm_inputs, samples = make_synthetic_decay_inputs(args.students, args.mean_len)
+    order = rng.permutation(len(samples))
+    batches = [[samples[i] for i in order[j:j+args.batch_size]] for j in range(0, len(order), args.batch_size)]
+
+    loop_batches = batches[:args.loop_batches]
+    loop, t_loop = timed(lambda: [_kc_weights_loop(lstm_inputs, [s for s, t in b], [t for s, t in b]) for b in loop_batches])
+    # the first epoch also fills the per-student cache
+    first, t_first = timed(lambda: [_kc_weights(lstm_inputs, [s for s, t in b], [t for s, t in b]) for b in batches])
+    _, t_cached = timed(lambda: [_kc_weights(lstm_inputs, [s for s, t in b], [t for s, t in b]) for b in batches])
+    for a, b in zip(loop, first):
+        for wa, wb in zip(a, b):
+            assert torch.allclose(wa.double(), wb, atol=1e-12)
+
+    cache_mb = sum(v['kc_sim'].nbytes for v in lstm_inputs.values()) / 2**20
+    print('{} students, {} samples, batches of {}'.format(args.students, len(samples), args.batch_size))
+    print('{:>26} {:>14} {:>16}'.format('', 'ms / batch', 'epoch est. (s)'))
+    for name, t, n in [('jaccard_score loop', t_loop, len(loop_batches)),
+                       ('matrix, first epoch', t_first, len(batches)),
+                       ('matrix, cached', t_cached, len(batches))]:
+        print('{:>26} {:>14.3f} {:>16.2f}'.format(name, 1000 * t / n, t / n * len(batches)))
+    print('cache: {:.1f} MB'.format(cache_mb))
+
+
+def _exp_decay_states(lstm_inputs, students, timesteps):
+    """exp_decay knowledge states as get_knowledge_states_for_generator computes them per batch (on CPU)."""
+    ks = []
+    for b in range(len(timesteps)):
+        w = torch.exp(-torch.arange(timesteps[b]+1).flip(dims=[0]).float())
+        w = (w / w.sum()).unsqueeze(0)
+        code_embs = torch.stack([torch.as_tensor(e) for e in lstm_inputs[students[b]]['code_emb'][:timesteps[b]+1]]).float()
+        ks.append(torch.mm(w, code_embs))
+    return torch.cat(ks)
+
+
+def bench_exp_decay(args):
+    rng = np.random.default_rng(0)
+    lstm_inputs, samples = make_synthetic_decay_inputs(args.students, args.mean_len)
+    order = rng.permutation(len(samples))
+    batches = [[samples[i] for i in order[j:j+args.batch_size]] for j in range(0, len(order), args.batch_size)]
+    configs = Munch(combine_method='exp_decay')
+
+    recomputed, t_recompute = timed(lambda: [_exp_decay_states(lstm_inputs, [s for s, t in b], [t for s, t in b]) for b in batches])
+    ks_table, t_build = timed(ExpDecayKnowledgeStateTable, lstm_inputs, configs, device='cpu')
+    looked_up, t_lookup = timed(lambda: [ks_table([s for s, t in b], [t for s, t in b]) for b in batches])
+    for a, b in zip(recomputed, looked_up):
+        assert torch.allclose(a, b, atol=1e-5)
+
+    print('{} students, {} samples, {} batches of {}'.format(args.students, len(samples), len(batches), args.batch_size))
+    print('{:>22} {:>14} {:>12}'.format('', 'ms / batch', 'epoch (s)'))
+    print('{:>22} {:>14.3f} {:>12.2f}'.format('prefix mm per sample', 1000 * t_recompute / len(batches), t_recompute))
+    print('{:>22} {:>14.3f} {:>12.2f}'.format('table lookup', 1000 * t_lookup / len(batches), t_lookup))
+    print('table built once in {:.2f} s, {:.1f} MB'.format(t_build, ks_table.states.element_size() * ks_table.states.nelement() / 2**20))
+
+
+def _decay_states_loop(lstm_inputs, students, timesteps, configs):
+    """The combine methods without the lstm as get_knowledge_states_for_generator computed them
+    before CodeEmbeddingBank: one history stacked (and copied to the device) per sample."""
+    if configs.combine_method == 'no_decay':
+        return [torch.as_tensor(lstm_inputs[students[b]]['code_emb'][timesteps[b]]).float() for b in range(len(timesteps))]
+    if 'exp_' in configs.combine_method:
+        exp_weights = []
+        for b in range(len(timesteps)):
+            w = torch.exp(-torch.arange(timesteps[b]+1).flip(dims=[0]).float())
+            exp_weights.append(w / w.sum())
+    if 'kc_' in configs.combine_method:
+        kc_weights = _kc_weights(lstm_inputs, students, timesteps)
+    if configs.combine_method == 'exp_decay':
+        weights = exp_weights
+    elif configs.combine_method == 'kc_sim_decay':
+        weights = kc_weights
+    elif configs.combine_method == 'exp_kc_decay':
+        weights = [exp_weights[i] * kc_weights[i] for i in range(len(exp_weights))]
+        weights = [w / w.sum() if w.sum() != 0 else torch.zeros_like(w) for w in weights]
+    ks = []
+    for b in range(len(timesteps)):
+        code_embs = torch.stack([torch.as_tensor(e) for e in lstm_inputs[students[b]]['code_emb'][:timesteps[b]+1]]).float()
+        ks.append(torch.mm(weights[b].unsqueeze(0).to(torch.float32), code_embs))
+    return torch.cat(ks)
+
+
+def bench_code_bank(args):
+    rng = np.random.default_rng(0)
+    lstm_inputs, samples = make_synthetic_decay_inputs(args.students, args.mean_len)
+    order = rng.permutation(len(samples))[:args.batches * args.batch_size]
+    batches = [[samples[i] for i in order[j:j+args.batch_size]] for j in range(0, len(order), args.batch_size)]
+    code_bank, t_build = timed(CodeEmbeddingBank, lstm_inputs, device='cpu')
+    for b in batches: # fill the kc_similarity cache for both
+        _kc_weights(lstm_inputs, [s for s, t in b], [t for s, t in b])
+
+    print('{} students, {} batches of {}; bank built once in {:.2f} s, {:.1f} MB'.format(
+        args.students, len(batches), args.batch_size, t_build, code_bank.embs.element_size() * code_bank.embs.nelement() / 2**20))
+    print('{:>14} {:>20} {:>14} {:>9}'.format('method', 'per sample (ms)', 'bank (ms)', 'speedup'))
+    for method in ['no_decay', 'exp_decay', 'kc_sim_decay', 'exp_kc_decay']:
+        configs = Munch(combine_method=method)
+        loop, t_loop = timed(lambda: [_decay_states_loop(lstm_inputs, [s for s, t in b], [t for s, t in b], configs) for b in batches])
+        banked, t_bank = timed(lambda: [decay_knowledge_states(code_bank, lstm_inputs, [s for s, t in b], [t for s, t in b], configs) for b in batches])
+        for a, b in zip(loop, banked):
+            assert torch.allclose(torch.stack(list(a)), b, atol=1e-5), method
+        print('{:>14} {:>20.3f} {:>14.3f} {:>8.2f}x'.format(method, 1000 * t_loop / len(batches), 1000 * t_bank / len(batches), t_loop / t_bank))
+
+
+def peak_memory_mb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 # peak RSS of the process
+
+
+def _mixed_precision_run(precision, args):
+    """OKT training steps as in generator_step (combine_method 'weight', train_lstm) in one precision;
+    runs in its own process so that the peak memory is its own."""
+    from transformers import GPT2Config, GPT2LMHeadModel
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    configs = Munch(mixed_precision=precision, train_lstm=True, use_lstm=True, kt_model='lstm', lstm_init='zero',
+                    lstm_hid_dim=768, packed_lstm=False, combine_method='weight', combine_weight=1, use_kc=False)
+    model = GPT2LMHeadModel(GPT2Config(n_layer=args.layers, n_positions=args.seq_len)).to(device)
+    lstm = torch.nn.LSTM(968, 768).to(device)
+    weight = torch.nn.Parameter(torch.tensor(1., device=device))
+    optimizers = [torch.optim.AdamW(model.parameters(), lr=1e-4), torch.optim.Adam([weight], lr=1e-3)]
+    optimizers_lstm = [torch.optim.RMSprop(lstm.parameters(), lr=1e-5, momentum=0.9)]
+    scaler = make_grad_scaler(configs)
+
+    lstm_inputs, samples = make_synthetic_lstm_inputs(64, 40)
+    rng = np.random.default_rng(0)
+    ids = torch.from_numpy(rng.integers(50257, size=(args.batch_size, args.seq_len))).to(device)
+    prompt_id_lens = rng.integers(20, 120, size=args.batch_size).tolist()
+    labels = ids.clone()
+    labels[torch.arange(args.seq_len, device=device).unsqueeze(0) <= torch.tensor(prompt_id_lens, device=device).unsqueeze(1)] = -100
+    batch = [samples[i] for i in rng.permutation(len(samples))[:args.batch_size]]
+
+    losses = []
+    for step in range(args.steps + 1):
+        if step == 1: # the first step warms up
+            start = time.perf_counter()
+        with autocast_context(configs):
+            ks, _ = lstm_knowledge_states(lstm, lstm_inputs, [s for s, t in batch], [t for s, t in batch], configs, device=device)
+            inputs_embeds = combine_knowledge_states(model.transformer.wte(ids), prompt_id_lens, ks, None, weight, configs)
+            loss = model(inputs_embeds=inputs_embeds, labels=labels).loss.float()
+        backward(loss, scaler)
+        step_optimizers(optimizers, scaler)
+        step_optimizers(optimizers_lstm, scaler)
+        for optimizer in optimizers + optimizers_lstm:
+            optimizer.zero_grad()
+        if scaler is not None:
+            scaler.update()
+        losses.append(loss.item())
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    return args.steps * args.batch_size * args.seq_len / elapsed, peak_memory_mb(), losses[-1]
+
+
+def bench_mixed_precision(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('{}: GPT-2 with {} layers, batch {} x {} tokens, {} steps'.format(device, args.layers, args.batch_size, args.seq_len, args.steps))
+    print('{:>10} {:>14} {:>18} {:>12}'.format('precision', 'tokens / s', 'peak memory (MB)', 'last loss'))
+    context = multiprocessing.get_context('spawn')
+    for precision in args.precision:
+        if precision == 'fp16' and device == 'cpu':
+            print('{:>10} {:>14} (the CPU LSTM has no fp16 kernels; fp16 is for the GPU)'.format(precision, '-'))
+            continue
+        with context.Pool(1) as pool:
+            tokens_per_sec, peak, loss = pool.apply(_mixed_precision_run, (precision, args))
+        print('{:>10} {:>14.0f} {:>18.0f} {:>12.4f}'.format(str(precision), tokens_per_sec, peak, loss))
+
+
+def _check_accumulation_windows(max_batches=12, max_steps=5):
+    """The loop of main_okt.py with accumulation_window on a linear model: every optimizer step gets
+    the mean gradient of the batches since the last step, the last (shorter) window included, and no
+    gradient is left over at the end of the epoch."""
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 1)
+    for n_batches in range(1, max_batches + 1):
+        batches = [(torch.randn(3, 4), torch.randn(3, 1)) for _ in range(n_batches)]
+        for accumulation_steps in range(1, max_steps + 1):
+            model.zero_grad()
+            window_grads, n_updates = [], 0
+            for idx, (x, y) in enumerate(batches):
+                loss = torch.nn.functional.mse_loss(model(x), y)
+                window_grads.append(torch.autograd.grad(loss, model.weight, retain_graph=True)[0])
+                loss_scale, update = accumulation_window(idx, n_batches, accumulation_steps)
+                backward(loss * loss_scale)
+                if update:
+                    assert torch.allclose(model.weight.grad, torch.stack(window_grads).mean(0), atol=1e-6)
+                    model.zero_grad()
+                    window_grads, n_updates = [], n_updates + 1
+            assert not window_grads and n_updates == math.ceil(n_batches / accumulation_steps)
+    print('accumulation windows: every update is the mean of its window for 1-{} batches and 1-{} steps'.format(max_batches, max_steps))
+
+
+def bench_grad_accumulation(args):
+    """Gradient of one batch vs. the same batch accumulated over micro-batches with the loss scaling
+    of main_okt.py (every micro-batch loss times 1 / No. micro-batches)."""
+    _check_accumulation_windows()
+    from transformers import GPT2Config, GPT2LMHeadModel
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(n_layer=args.layers, n_positions=args.seq_len))
+    model.eval() # no dropout, so both gradients are of the same function
+    rng = np.random.default_rng(0)
+    ids = torch.from_numpy(rng.integers(50257, size=(args.batch_size, args.seq_len)))
+    # every micro-batch has the same No. label tokens, so the mean of the micro-batch means is the batch mean
+    labels = ids.clone()
+    labels[:, :args.seq_len // 4] = -100
+
+    def gradient(micro_batch_size):
+        model.zero_grad()
+        start = time.perf_counter()
+        n_micro = math.ceil(args.batch_size / micro_batch_size)
+        for i in range(0, args.batch_size, micro_batch_size):
+            loss = model(input_ids=ids[i:i + micro_batch_size], labels=labels[i:i + micro_batch_size]).loss
+            backward(loss * (1 / n_micro))
+        elapsed = time.perf_counter() - start
+        return torch.cat([p.grad.flatten() for p in model.parameters()]), elapsed
+
+    full, full_time = gradient(args.batch_size)
+    print('batch {} x {} tokens, GPT-2 with {} layers'.format(args.batch_size, args.seq_len, args.layers))
+    print('{:>12} {:>10} {:>12} {:>16}'.format('micro-batch', 'steps', 'time (ms)', 'rel. grad diff'))
+    print('{:>12} {:>10} {:>12.1f} {:>16}'.format(args.batch_size, 1, full_time * 1000, '-'))
+    for micro_batch_size in args.micro_batch_size:
+        grad, elapsed = gradient(micro_batch_size)
+        diff = ((grad - full).norm() / full.norm()).item()
+        assert diff <= 1e-5, diff
+        print('{:>12} {:>10} {:>12.1f} {:>16.2e}'.format(micro_batch_size, math.ceil(args.batch_size / micro_batch_size),
+                                                         elapsed * 1000, diff))
+
+
+def bench_load_dataset(args):
+    print('{:>10} {:>14} {:>16}'.format('rows', 'pickle (s)', 'columnar (s)'))
+    for n_rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pkl_path = os.path.join(tmp_dir, 'dataset.pkl')
+            columnar_dir = os.path.join(tmp_dir, 'dataset_columnar')
+            make_synthetic_dataset(n_rows).to_pickle(pkl_path)
+            convert_pickle_to_columnar(pkl_path, columnar_dir)
+
+            from_pickle, t_pickle = timed(pd.read_pickle, pkl_path)
+            from_columnar, t_columnar = timed(load_columnar_dataset, columnar_dir)
+            assert list(from_pickle.columns) == list(from_columnar.columns)
+            for col in from_pickle.columns:
+                for a, b in zip(from_pickle[col], from_columnar[col]):
+                    assert type(a) == type(b) and np.array_equal(np.asarray(a), np.asarray(b)), col
+            print('{:>10} {:>14.3f} {:>16.3f}'.format(n_rows, t_pickle, t_columnar))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Data pipeline micro-benchmarks.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    split_parser = subparsers.add_parser(
+        'split_records', help="split_student_records vs. the per-row iloc loop")
+    split_parser.add_argument('--rows', type=int, nargs='+', default=[40000, 1000000, 10000000])
+    split_parser.add_argument('--max_len', type=int, default=200)
+    split_parser.add_argument('--loop_max_rows', type=int, default=200000,
+                              help="largest prefix the per-row loop is actually run on (default: %(default)s)")
+    split_parser.set_defaults(func=bench_split_records)
+
+    collate_parser = subparsers.add_parser(
+        'collate', help="CollateForOKT throughput: per-row EOS loop vs. vectorized vs. pre-tokenized")
+    collate_parser.add_argument('--samples', type=int, default=2048)
+    collate_parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 8, 32, 128])
+    collate_parser.add_argument('--repeat', type=int, default=3)
+    collate_parser.add_argument('--tokenizer', default='gpt2', help="tokenizer name or path (default: %(default)s)")
+    collate_parser.add_argument('--pad_token', choices=['pad', 'eos'], default='pad')
+    collate_parser.set_defaults(func=bench_collate)
+
+    lstm_parser = subparsers.add_parser(
+        'lstm_collate', help="student-model (main_student_model.py) batches/sec: row lists vs. per-student tensors")
+    lstm_parser.add_argument('--students', type=int, default=400)
+    lstm_parser.add_argument('--mean_len', type=int, default=162)
+    lstm_parser.add_argument('--batch_size', type=int, default=64)
+    lstm_parser.add_argument('--repeat', type=int, default=3)
+    lstm_parser.set_defaults(func=bench_lstm_collate)
+
+    rss_parser = subparsers.add_parser(
+        'worker_rss', help="per-worker private memory over an epoch: list-of-dicts vs. array-backed OKT dataset")
+    rss_parser.add_argument('--samples', type=int, default=100000)
+    rss_parser.add_argument('--workers', type=int, default=2)
+    rss_parser.add_argument('--batch_size', type=int, default=8)
+    rss_parser.set_defaults(func=bench_worker_rss)
+
+    dtype_parser = subparsers.add_parser(
+        'embedding_dtype', help="dataset RAM/disk and student-model AUC with float32/float16/bfloat16 embeddings")
+    dtype_parser.add_argument('--students', type=int, default=300)
+    dtype_parser.add_argument('--mean_len', type=int, default=60)
+    dtype_parser.add_argument('--hidden_dim', type=int, default=64)
+    dtype_parser.add_argument('--epochs', type=int, default=3)
+    dtype_parser.add_argument('--auc_tolerance', type=float, default=0.005)
+    dtype_parser.set_defaults(func=bench_embedding_dtype)
+
+    ks_parser = subparsers.add_parser(
+        'knowledge_states', help="frozen-lstm knowledge states: lstm over every batch vs. KnowledgeStateTable lookup")
+    ks_parser.add_argument('--students', type=int, default=400)
+    ks_parser.add_argument('--mean_len', type=int, default=60)
+    ks_parser.add_argument('--hidden_dim', type=int, default=768)
+    ks_parser.add_argument('--batch_size', type=int, default=8)
+    ks_parser.add_argument('--batches', type=int, default=200, help="batches timed (default: %(default)s)")
+    ks_parser.set_defaults(func=bench_knowledge_states)
+
+    student_parser = subparsers.add_parser(
+        'student_batches', help="lstm work per OKT batch (train_lstm) with random vs. student-grouped batches")
+    student_parser.add_argument('--students', type=int, default=400)
+    student_parser.add_argument('--mean_len', type=int, default=60)
+    student_parser.add_argument('--hidden_dim', type=int, default=768)
+    student_parser.add_argument('--batch_size', type=int, default=8)
+    student_parser.add_argument('--group_size', type=int, nargs='+', default=[1, 2, 4, 8])
+    student_parser.add_argument('--batches', type=int, default=100, help="batches timed (default: %(default)s)")
+    student_parser.add_argument('--packed_lstm', action='store_true', help="pack the sequences (configs.packed_lstm)")
+    student_parser.set_defaults(func=bench_student_batches)
+
+    packed_parser = subparsers.add_parser(
+        'packed_lstm', help="lstm forward + backward over padded vs. packed student sequences")
+    packed_parser.add_argument('--distribution', nargs='+', choices=['poisson', 'lognormal'], default=['poisson', 'lognormal'])
+    packed_parser.add_argument('--mean_len', type=int, default=40)
+    packed_parser.add_argument('--hidden_dim', type=int, default=768)
+    packed_parser.add_argument('--batch_size', type=int, nargs='+', default=[8, 64])
+    packed_parser.add_argument('--batches', type=int, default=10, help="batches timed (default: %(default)s)")
+    packed_parser.set_defaults(func=bench_packed_lstm)
+
+    inject_parser = subparsers.add_parser(
+        'inject_ks', help="knowledge states into the prompt embeddings: per-row loop vs. combine_knowledge_states")
+    inject_parser.add_argument('--batch_size', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    inject_parser.add_argument('--seq_len', type=int, default=384)
+    inject_parser.add_argument('--repeat', type=int, default=3)
+    inject_parser.set_defaults(func=bench_inject_ks)
+
+    kc_parser = subparsers.add_parser(
+        'kc_weights', help="kc_sim_decay weights: per-pair jaccard_score loop vs. cached matrix form")
+    kc_parser.add_argument('--students', type=int, default=400)
+    kc_parser.add_argument('--mean_len', type=int, default=60)
+    kc_parser.add_argument('--batch_size', type=int, default=8)
+    kc_parser.add_argument('--loop_batches', type=int, default=50, help="batches the loop is actually run on (default: %(default)s)")
+    kc_parser.set_defaults(func=bench_kc_weights)
+
+    decay_parser = subparsers.add_parser(
+        'exp_decay', help="exp_decay knowledge states: weighted prefix sum per sample vs. ExpDecayKnowledgeStateTable")
+    decay_parser.add_argument('--students', type=int, default=400)
+    decay_parser.add_argument('--mean_len', type=int, default=60)
+    decay_parser.add_argument('--batch_size', type=int, default=8)
+    decay_parser.set_defaults(func=bench_exp_decay)
+
+    bank_parser = subparsers.add_parser(
+        'code_bank', help="combine methods without the lstm: per-sample histories vs. CodeEmbeddingBank gather")
+    bank_parser.add_argument('--students', type=int, default=400)
+    bank_parser.add_argument('--mean_len', type=int, default=60)
+    bank_parser.add_argument('--batch_size', type=int, default=8)
+    bank_parser.add_argument('--batches', type=int, default=500)
+    bank_parser.set_defaults(func=bench_code_bank)
+
+    amp_parser = subparsers.add_parser(
+        'mixed_precision', help="OKT training step tokens/sec and peak memory: fp32 vs. bf16 vs. fp16 autocast")
+    amp_parser.add_argument('--precision', nargs='+', choices=['fp32', 'bf16', 'fp16'], default=['fp32', 'bf16', 'fp16'])
+    amp_parser.add_argument('--layers', type=int, default=4)
+    amp_parser.add_argument('--batch_size', type=int, default=8)
+    amp_parser.add_argument('--seq_len', type=int, default=256)
+    amp_parser.add_argument('--steps', type=int, default=5)
+    amp_parser.set_defaults(func=bench_mixed_precision)
+
+    accum_parser = subparsers.add_parser(
+        'grad_accumulation', help="full-batch gradient vs. the gradient accumulated over micro-batches")
+    accum_parser.add_argument('--batch_size', type=int, default=16)
+    accum_parser.add_argument('--micro_batch_size', type=int, nargs='+', default=[8, 4, 2])
+    accum_parser.add_argument('--layers', type=int, default=2)
+    accum_parser.add_argument('--seq_len', type=int, default=128)
+    accum_parser.set_defaults(func=bench_grad_accumulation)
+
+    load_parser = subparsers.add_parser(
+        'load_dataset', help="pd.read_pickle(dataset.pkl) vs. load_columnar_dataset")
+    load_parser.add_argument('--rows', type=int, nargs='+', default=[40000, 200000])
+    load_parser.set_defaults(func=bench_load_dataset)
+
+    make_parser = subparsers.add_parser(
+        'make_dataset', help="make_pytorch_dataset (OKT) vs. the per-student filter loop")
+    make_parser.add_argument('--students', type=int, nargs='+', default=[250, 5000, 50000])
+    make_parser.add_argument('--mean_len', type=int, default=20,
+                             help="mean submissions per student (default: %(default)s)")
+    make_parser.add_argument('--loop_max_students', type=int, default=200)
+    make_parser.set_defaults(func=bench_make_dataset)
+
+    sampler_parser = subparsers.add_parser(
+        'batch_sampler', help="padding efficiency of random vs. length-bucketed vs. token-budget OKT batches")
+    sampler_parser.add_argument('--samples', type=int, default=30000)
+    sampler_parser.add_argument('--batch_size', type=int, default=8)
+    sampler_parser.add_argument('--bucket_size_multiplier', type=int, nargs='+', default=[10, 50, 200])
+    sampler_parser.add_argument('--max_tokens_per_batch', type=int, nargs='+', default=[4096, 8192])
+    sampler_parser.set_defaults(func=bench_batch_sampler)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Stream OKT samples from the per-user Project CodeNet CSVs instead of data/dataset.pkl.
+
+data_merge.py / data_procee.py write one <user_id>.csv per user, sorted by date, and
+match_code.py appends the submitted code as a `code_content` column. CodeNetStream reads
+those files lazily, one user at a time, and turns each user into the same samples that
+make_pytorch_dataset builds for OKT, with the max_len splitting and label logic of read_data:
+
+    - submissions without code are skipped
+    - labels: Score_y is 2 for Accepted, 1 for partially passed tests, 0 otherwise;
+      Score_x is the fraction of passed tests; make_labels picks one by configs.label_type
+    - first_ast_convertible keeps the first submission of the user to every problem
+    - records longer than max_len are split into <user_id>_1, <user_id>_2, ... and the
+      first submission of every record only serves as history (timestep 0 is dropped)
+
+The train/valid/test split is on users (split_user_csvs). Only a shuffle buffer of samples is
+held in memory, and DataLoader workers read disjoint sets of users.
+
+The CSVs have neither problem statements nor embeddings: prompts default to the problem id,
+and prompt embeddings/KC vectors to zeros, unless lookups keyed by problem_id are given.
+The knowledge states need the code embeddings of every user's history: CodeNetHistories
+reads them from one <user_id>.npy per user (one ASTNN embedding per CSV row, in CSV order)
+and builds the lstm_inputs of a user's records when a batch first asks for them.
+"""
+import csv
+import glob
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.model_selection import train_test_split
+
+from data_loader import make_labels, pretokenize_okt_dataset
+
+csv.field_size_limit(1000000000) # code_content can be long
+
+
+def list_user_csvs(userdata_dir):
+    '''
+    all per-user CSVs under userdata_dir (one language directory of match_code.py), sorted
+    '''
+    return sorted(glob.glob(os.path.join(userdata_dir, '*.csv')))
+
+
+def split_user_csvs(user_csvs, configs):
+    '''
+    split the users into train/valid/test like read_data splits the students
+    '''
+    train_csvs, test_csvs = train_test_split(user_csvs, test_size=configs.test_size, random_state=configs.seed)
+    valid_csvs, test_csvs = train_test_split(test_csvs, test_size=0.5, random_state=configs.seed)
+    return train_csvs, valid_csvs, test_csvs
+
+
+def load_problem_descriptions(description_dir):
+    '''
+    problem statements from Project_CodeNet/problem_descriptions/<problem_id>.html, as plain text
+    '''
+    prompts = {}
+    for path in glob.glob(os.path.join(description_dir, 'p*.html')):
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            text = re.sub(r'<[^>]+>', ' ', f.read())
+        prompts[os.path.basename(path)[:-len('.html')]] = ' '.join(text.split())
+    return prompts
+
+
+def parse_accuracy(accuracy, status):
+    '''
+    fraction of passed tests from the `accuracy` column ("passed/total" or a number);
+    falls back on the status when it is missing (None for a short CSV row) or malformed
+    '''
+    try:
+        if '/' in accuracy:
+            passed, total = accuracy.split('/')
+            return float(passed) / float(total) if float(total) > 0 else 0.
+        return float(accuracy)
+    except (TypeError, ValueError):
+        return 1. if status == 'Accepted' else 0.
+
+
+def read_user_rows(path, configs):
+    '''
+    submissions of one user with code, in the order of the CSV; every row keeps its position in 
+    the CSV as 'row_index' (the row of its code embedding, see CodeNetHistories)
+    '''
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = [dict(row, row_index=i) for i, row in enumerate(csv.DictReader(f)) if row.get('code_content')]
+    if configs.first_ast_convertible:
+        seen = set()
+        rows = [row for row in rows if not (row['problem_id'] in seen or seen.add(row['problem_id']))]
+    return rows
+
+
+def record_id(user_id, position, max_len):
+    '''
+    the SubjectID of the record holding a user's position-th submission, as read_data splits students
+    '''
+    return '{}_{}'.format(user_id, position // max_len + 1)
+
+
+class CodeNetHistories(object):
+    '''
+    lstm_inputs (see make_pytorch_dataset) of the records of CodeNetStream, keyed by SubjectID, 
+    built per user on first use and kept for the cache_users most recently used users:
+        kt_model 'lstm'         : the lstm input of every response, prompt embedding + code embedding
+        decay combine methods   : {'code_emb': [...], 'prompt_kc': [...]}
+    @param user_csvs: per-user CSVs of the records that will be asked for
+    @param embedding_dir: <user_id>.npy with the code embedding of every row of <user_id>.csv
+    @param prompt_embs, kc_vecs: optional dicts keyed by problem_id, as for CodeNetStream
+    '''
+    def __init__(self, user_csvs, configs, embedding_dir, prompt_embs=None, kc_vecs=None,
+                 prompt_emb_dim=768, cache_users=4096):
+        if configs.combine_method not in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay'] and configs.kt_model != 'lstm':
+            raise ValueError('kt_model {} needs question/code ids over the whole dataset, which the stream does not have'.format(configs.kt_model))
+        self.user_csvs = {os.path.basename(path)[:-len('.csv')]: path for path in user_csvs}
+        self.configs = configs
+        self.embedding_dir = embedding_dir
+        self.prompt_embs = prompt_embs or {}
+        self.kc_vecs = kc_vecs
+        self.empty_prompt_emb = np.zeros(prompt_emb_dim, dtype=np.float32)
+        self.cache_users = cache_users
+        self.cache = OrderedDict()
+
+    def user_histories(self, user_id):
+        '''
+        lstm_inputs of all records of one user
+        '''
+        rows = read_user_rows(self.user_csvs[user_id], self.configs)
+        code_embs = np.load(os.path.join(self.embedding_dir, user_id + '.npy'), mmap_mode='r')
+        code_embs = np.asarray(code_embs[[row['row_index'] for row in rows]], dtype=np.float32)
+        histories = {}
+        for position, (row, code_emb) in enumerate(zip(rows, code_embs)):
+            history = histories.setdefault(record_id(user_id, position, self.configs.max_len), [])
+            history.append((row['problem_id'], code_emb))
+        for record, history in histories.items():
+            if self.configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
+                histories[record] = {'code_emb': [code_emb for _, code_emb in history],
+                                     'prompt_kc': [self.kc_vecs[p] if self.kc_vecs is not None else 0 for p, _ in history]}
+            else:
+                # same layout as the lstm input of the student model: prompt=[768], ASTNN=[200]
+                histories[record] = [torch.from_numpy(np.concatenate([self.prompt_embs.get(p, self.empty_prompt_emb), code_emb]).astype(np.float32))
+                                     for p, code_emb in history]
+        return histories
+
+    def __getitem__(self, student):
+        user_id = student.rsplit('_', 1)[0]
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+        else:
+            self.cache[user_id] = self.user_histories(user_id)
+            if len(self.cache) > self.cache_users:
+                self.cache.popitem(last=False)
+        return self.cache[user_id][student]
+
+    def __contains__(self, student):
+        return student.rsplit('_', 1)[0] in self.user_csvs
+
+
+class CodeNetStream(torch.utils.data.IterableDataset):
+    '''
+    @param user_csvs: per-user CSVs to stream (e.g. one split of split_user_csvs)
+    @param configs: label_type, max_len, first_ast_convertible and seed as in configs_okt.yaml
+    @param tokenizer: if given, samples are pre-tokenized (see pretokenize_okt_dataset)
+    @param prompts, prompt_embs, kc_vecs: optional dicts keyed by problem_id
+    @param shuffle: shuffle the users every epoch and the samples within a buffer of shuffle_buffer
+    '''
+    def __init__(self, user_csvs, configs, tokenizer=None, prompts=None, prompt_embs=None, kc_vecs=None,
+                 shuffle=False, shuffle_buffer=1000, prompt_emb_dim=768):
+        self.user_csvs = list(user_csvs)
+        self.configs = configs
+        self.tokenizer = tokenizer
+        self.prompts = prompts or {}
+        self.prompt_embs = prompt_embs or {}
+        self.kc_vecs = kc_vecs
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.empty_prompt_emb = np.zeros(prompt_emb_dim, dtype=np.float32)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+        call before every epoch to get a new order when shuffling
+        '''
+        self.epoch = epoch
+
+    def user_samples(self, path):
+        '''
+        the OKT samples of one user, as made by make_pytorch_dataset
+        '''
+        rows = read_user_rows(path, self.configs)
+        if len(rows) == 0:
+            return []
+        user_id = os.path.basename(path)[:-len('.csv')]
+        scores_x = np.array([parse_accuracy(row.get('accuracy', ''), row['status']) for row in rows])
+        scores_y = np.where([row['status'] == 'Accepted' for row in rows], 2, np.where(scores_x > 0, 1, 0))
+        scores = make_labels(scores_x, scores_y, self.configs.label_type)
+
+        samples = []
+        for position, (row, score) in enumerate(zip(rows, scores)):
+            timestep = position % self.configs.max_len
+            if timestep == 0:
+                continue
+            problem_id = row['problem_id']
+            samples.append({
+                'SubjectID': record_id(user_id, position, self.configs.max_len),
+                'ProblemID': problem_id,
+                'step': np.int64(timestep - 1),
+                'next_Score': score,
+                'next_prompt': self.prompts.get(problem_id, problem_id),
+                'next_prompt_emb': self.prompt_embs.get(problem_id, self.empty_prompt_emb),
+                'next_prompt_kc': self.kc_vecs[problem_id] if self.kc_vecs is not None else 0,
+                'next_code': row['code_content'],
+            })
+        if self.tokenizer is not None:
+            samples = pretokenize_okt_dataset(samples, self.tokenizer)
+        return samples
+
+    def n_samples(self):
+        '''
+        No. samples of an epoch, from one pass over the CSVs (the first submission of every record 
+        is only history); e.g. to size the learning rate schedule
+        '''
+        n = 0
+        for path in self.user_csvs:
+            n_rows = len(read_user_rows(path, self.configs))
+            n += n_rows - (n_rows + self.configs.max_len - 1) // self.configs.max_len
+        return n
+
+    def worker_user_csvs(self):
+        '''
+        this worker's share of the users; every worker shuffles with the same seed, so the shares are disjoint
+        '''
+        user_csvs = self.user_csvs
+        if self.shuffle:
+            order = np.random.default_rng(self.configs.seed + self.epoch).permutation(len(user_csvs))
+            user_csvs = [user_csvs[i] for i in order]
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            user_csvs = user_csvs[worker_info.id::worker_info.num_workers]
+        return user_csvs
+
+    def __iter__(self):
+        if not self.shuffle:
+            for path in self.worker_user_csvs():
+                yield from self.user_samples(path)
+            return
+
+        worker_info = torch.utils.data.get_worker_info()
+        rng = np.random.default_rng([self.configs.seed, self.epoch, worker_info.id if worker_info else 0])
+        buffer = []
+        for path in self.worker_user_csvs():
+            for sample in self.user_samples(path):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def prepare_codenet_data(configs, tokenizer=None):
+    '''
+    the CodeNet counterpart of prepare_data: train/valid/test streams over the users of 
+    configs.codenet_userdata and the lstm_inputs of all their records
+    '''
+    train_csvs, valid_csvs, test_csvs = split_user_csvs(list_user_csvs(configs.codenet_userdata), configs)
+    prompts = load_problem_descriptions(configs.codenet_problem_descriptions) if configs.get('codenet_problem_descriptions') else None
+    prompt_embs = pd.read_pickle(configs.codenet_prompt_embeddings) if configs.get('codenet_prompt_embeddings') else None
+    data = {'lstm_inputs': CodeNetHistories(train_csvs + valid_csvs + test_csvs, configs, configs.codenet_embedding_dir,
+                                            prompt_embs=prompt_embs)}
+    for split, user_csvs in [('train', train_csvs), ('valid', valid_csvs), ('test', test_csvs)]:
+        data[split] = CodeNetStream(user_csvs, configs, tokenizer=tokenizer, prompts=prompts, prompt_embs=prompt_embs,
+                                    shuffle=split == 'train')
+    return data
@@ -1,3 +1,8 @@
+import os
+import json
+import hashlib
+import itertools
+import pickle
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -6,9 +11,19 @@ from collections import defaultdict
 from sklearn.model_selection import train_test_split
 
 from utils import set_random_seed, tokenize_function, prompt_proc_func, code_proc_func
+from dataset_store import COLUMNAR_DIRNAME, load_columnar_dataset, cast_embedding_columns, is_columnar_current, \
+                          stored_embedding_dtype
+from array_dataset import OKTArrayDataset, StudentArrayDataset
 
 from pdb import set_trace
 
+KC_EXCLUDE_COLS = ['AssignmentID', 'ProblemID', 'Requirement'] # non-KC columns of prompt_concept.xlsx, hardcoded
+# configs that change the output of read_data/make_pytorch_dataset, see prepare_data
+PREPROCESS_CACHE_KEYS = ['data_for', 'label_type', 'max_len', 'first_ast_convertible', 'use_kc', 
+                         'split_method', 'test_size', 'seed', 'combine_method', 'kt_model', 'embedding_dtype']
+# bump when the layout of the prepared datasets changes, so that stale caches are not loaded
+PREPROCESS_CACHE_VERSION = 4
+
 
 def read_data(configs):
     '''
@@ -17,31 +32,23 @@ def read_data(configs):
                     than this number will be truncated and set as new student(s)
     @param configs.seed: reproducibility
     '''
-    # load dataset
-    dataset = pd.read_pickle(configs.data_path + '/dataset.pkl')
+    # load dataset; use the memory-mapped columnar copy if it is converted from the current pickle (see dataset_store.py)
+    if use_columnar_copy(configs.data_path):
+        dataset = load_columnar_dataset(os.path.join(configs.data_path, COLUMNAR_DIRNAME))
+    else:
+        dataset = pd.read_pickle(configs.data_path + '/dataset.pkl')
     
     ## if only testing, subsample part of dataset
     if configs.testing:
         dataset = dataset.sample(n=500)
     
     # choose label format
-    if configs.label_type == 'binary':
-        scores_y = []
-        for item in dataset['Score_y']:
-            if item >= 2:
-                scores_y.append(1)
-            else:
-                scores_y.append(0)
-        dataset['Score'] = scores_y
-    elif configs.label_type == 'ternery':
-        dataset['Score'] = dataset['Score_y']
-    elif configs.label_type == 'raw':
-        dataset['Score'] = dataset['Score_x']
+    dataset['Score'] = make_labels(dataset['Score_x'], dataset['Score_y'], configs.label_type)
     dataset = dataset.drop(columns=['Score_x','Score_y'])
     
     # convert prompt embedding to tensor
     if configs.data_for == 'lstm':
-        dataset['prompt-embedding'] = dataset['prompt-embedding'].apply(lambda x: torch.tensor(x))
+        dataset['prompt-embedding'] = dataset['prompt-embedding'].apply(lambda x: torch.as_tensor(x))
     
     ## optionally keep only the first answer by the student
     if configs.first_ast_convertible:
@@ -52,45 +59,26 @@ def read_data(configs):
     
     ## split a student's record into multiples 
     ## if it exceeds configs.max_len, change the subject ID to next one
-    prev_subject_id = 0
-    subjectid_appedix = []
-    timesteps = []
-    for i in tqdm(range(len(dataset)), desc="splitting students' records ..."):
-        if prev_subject_id != dataset.iloc[i].SubjectID:
-            # when encountering a new student ID
-            prev_subject_id = dataset.iloc[i].SubjectID
-            accumulated = 0
-            id_appendix = 1
-        else:
-            accumulated += 1
-            if accumulated >= configs.max_len:
-                id_appendix += 1
-                accumulated = 0
-        timesteps.append(accumulated)
-        subjectid_appedix.append(id_appendix)
-    dataset['timestep'] = timesteps
-    dataset['SubjectID_appendix'] = subjectid_appedix
-    dataset['SubjectID'] = [dataset.iloc[i].SubjectID + \
-                '_{}'.format(dataset.iloc[i].SubjectID_appendix) for i in range(len(dataset))]
+    dataset = split_student_records(dataset, configs.max_len)
+    
+    ## keep the embeddings in configs.embedding_dtype, optionally float16/bfloat16; batches are upcast to float32.
+    ## a columnar copy stored in another precision is cast as well
+    embedding_dtype = configs.get('embedding_dtype', 'float32')
+    if embedding_dtype != stored_embedding_dtype(dataset):
+        dataset = cast_embedding_columns(dataset, embedding_dtype)
         
     ## Each subject ID implies a student
     students = dataset['SubjectID'].unique()
     
     ## optionally load the knowledge component
     if configs.use_kc:
-        kc_collections = []
         print('use knowledge components')
-        kc_all = pd.read_excel(configs.data_path + '/prompt_concept.xlsx')
-        exclude_cols = ['AssignmentID', 'ProblemID', 'Requirement'] # this part is hardcoded
-        kc_len = len(kc_all.columns) - len(exclude_cols)
-        for row in range(len(dataset)):
-            kc_vec = np.zeros(kc_len)
-            kc = kc_all[kc_all.ProblemID == dataset.iloc[row].ProblemID]
-            for idx, col in enumerate(kc_all.columns):
-                if col not in exclude_cols and kc[col].item() == 1:
-                    kc_vec[idx-3] = 1
-            kc_collections.append(kc_vec)
-        dataset['kc_vec'] = kc_collections
+        kc_problem_ids, kc_table = load_kc_table(configs.data_path)
+        problem_ids = dataset.ProblemID.to_numpy()
+        unknown = np.setdiff1d(problem_ids, kc_problem_ids)
+        if len(unknown):
+            raise ValueError('ProblemID(s) {} missing from prompt_concept.xlsx'.format(unknown.tolist()))
+        dataset['kc_vec'] = list(kc_table[problem_ids])
     else:
         dataset['kc_vec'] = [0] * len(dataset)
     
@@ -119,77 +107,213 @@ def read_data(configs):
         return trainset, validset, testset, dataset
         
         
+def use_columnar_copy(data_path):
+    '''
+    whether read_data loads data_path/dataset_columnar instead of data_path/dataset.pkl: only if 
+    it exists and was converted from the pickle as it is now; a stale copy is reported and skipped
+    '''
+    columnar_dir = os.path.join(data_path, COLUMNAR_DIRNAME)
+    if not os.path.exists(os.path.join(columnar_dir, 'meta.json')):
+        return False
+    if not is_columnar_current(columnar_dir, os.path.join(data_path, 'dataset.pkl')):
+        print('{} was converted from another dataset.pkl, loading the pickle; re-run dataset_store.py to convert it again'.format(columnar_dir))
+        return False
+    return True
+
+
+def make_labels(scores_x, scores_y, label_type):
+    '''
+    @param scores_x: raw (continuous) scores in [0, 1]
+    @param scores_y: ternery scores; 0 wrong, 1 partially correct, 2 correct
+    @param label_type: 'binary' (correct or not), 'ternery' or 'raw'
+    '''
+    if label_type == 'binary':
+        return (np.asarray(scores_y) >= 2).astype(np.int64)
+    elif label_type == 'ternery':
+        return scores_y
+    elif label_type == 'raw':
+        return scores_x
+    raise ValueError('Invalid label type: {}'.format(label_type))
+
+
+def compile_kc_table(xlsx_path):
+    '''
+    compile the ProblemID -> knowledge component table into a dense array
+    @return: problem_ids listed in the xlsx, and kc_table of shape [max ProblemID + 1, No. KC]
+             where kc_table[ProblemID] is the binary KC vector of that problem
+    '''
+    kc_all = pd.read_excel(xlsx_path)
+    kc_len = len(kc_all.columns) - len(KC_EXCLUDE_COLS)
+    problem_ids = kc_all.ProblemID.to_numpy().astype(np.int64)
+    kc_table = np.zeros((problem_ids.max() + 1, kc_len))
+    for idx, col in enumerate(kc_all.columns):
+        if col not in KC_EXCLUDE_COLS:
+            kc_table[problem_ids[kc_all[col].to_numpy() == 1], idx-3] = 1
+    return problem_ids, kc_table
+
+
+def load_kc_table(data_path):
+    '''
+    load the compiled KC table, cached next to prompt_concept.xlsx and rebuilt
+    whenever the content of the xlsx changes
+    '''
+    xlsx_path = os.path.join(data_path, 'prompt_concept.xlsx')
+    cache_path = os.path.join(data_path, 'prompt_concept.kc.npz')
+    with open(xlsx_path, 'rb') as f:
+        fingerprint = hashlib.sha1(f.read()).hexdigest()
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if str(cache['fingerprint']) == fingerprint:
+            return cache['problem_ids'], cache['kc_table']
+    
+    problem_ids, kc_table = compile_kc_table(xlsx_path)
+    with open(cache_path + '.tmp', 'wb') as f:
+        np.savez(f, fingerprint=fingerprint, problem_ids=problem_ids, kc_table=kc_table)
+    os.replace(cache_path + '.tmp', cache_path)
+    return problem_ids, kc_table
+
+
+def split_student_records(dataset, max_len):
+    '''
+    split each student's record into chunks of at most max_len submissions and
+    assign the within-chunk timestep. a new record starts whenever SubjectID
+    changes from the previous row, i.e. each student's rows are expected to be
+    contiguous.
+    @param dataset: dataframe with a SubjectID column
+    @param max_len: maximum allowed length for each student's answer sequence
+    @return: dataset with timestep, SubjectID_appendix and the rewritten
+             SubjectID ('<SubjectID>_<appendix>') columns
+    '''
+    subject_ids = dataset['SubjectID']
+    # consecutive rows with the same SubjectID form one record
+    record_ids = (subject_ids != subject_ids.shift()).cumsum()
+    position = dataset.groupby(record_ids).cumcount()
+    appendix = position // max_len + 1
+    dataset['timestep'] = position % max_len
+    dataset['SubjectID_appendix'] = appendix
+    dataset['SubjectID'] = subject_ids + '_' + appendix.astype(str)
+    return dataset
+
+
+def group_rows_by_student(subject_ids):
+    '''
+    positional row indices of every student in a single pass (instead of one boolean
+    filter over the whole frame per student)
+    @param subject_ids: SubjectID column
+    @return: dict, key=student id in order of first appearance, value=array of that student's row positions in frame order
+    '''
+    codes, uniques = pd.factorize(subject_ids)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    return dict(zip(uniques, np.split(order, bounds[:-1])))
+
+
+def stack_embedding_column(column):
+    '''
+    stack a column of per-row embeddings (tensors or arrays) into one [N, D] tensor; 
+    float32, unless the rows are kept in reduced precision (see configs.embedding_dtype)
+    '''
+    rows = [torch.as_tensor(v) for v in column]
+    dtype = rows[0].dtype if rows[0].dtype in (torch.float16, torch.bfloat16) else torch.float32
+    return torch.stack(rows).to(dtype)
+
+
 def make_pytorch_dataset(dataset_split, dataset_full, students, configs, do_lstm_dataset=True):
     '''
     convert the pandas dataframe into dataset format that pytorch dataloader takes
     the resulting format is a list of dictionaries
     '''
     if configs.data_for == 'lstm':
+        # one contiguous tensor per student: Score [T], prompt-embedding [T, 768], input [T, 968]
         lstm_dataset = []
+        student_rows = group_rows_by_student(dataset_full.SubjectID)
+        problem_ids = dataset_full.ProblemID.to_numpy()
+        scores = dataset_full.Score.to_numpy().astype(np.float32)
+        prompt_embs = stack_embedding_column(dataset_full['prompt-embedding'])
+        inputs = stack_embedding_column(dataset_full.input)
     
         for student in students:
-            subset = dataset_full[dataset_full.SubjectID==student]
-            if configs.data_for == 'lstm':
-                lstm_dataset.append({
-                    'SubjectID': student,
-                    'ProblemID_seq': subset.ProblemID.tolist(),
-                    'Score': subset.Score.tolist(),
-                    'prompt-embedding': subset['prompt-embedding'].tolist(),
-                    'input': subset.input.tolist(),
-                })
+            rows = student_rows.get(student, np.array([], dtype=np.int64))
+            lstm_dataset.append({
+                'SubjectID': student,
+                'ProblemID_seq': problem_ids[rows].tolist(),
+                'Score': torch.from_numpy(scores[rows]),
+                'prompt-embedding': prompt_embs[torch.from_numpy(rows)],
+                'input': inputs[torch.from_numpy(rows)],
+            })
         del dataset_full
         return lstm_dataset
     
     elif configs.data_for == 'okt':
-        okt_dataset = []
-        students = dataset_split['SubjectID'].unique()
-        for student in students:
-            subset = dataset_split[dataset_split.SubjectID==student]
-            for t in range(len(subset)):
-                # IMPORTANT: we want to predict the student's answer to the NEXT time step's question prompt
-                okt_dataset.append({
-                    'SubjectID': student,
-                    'step': subset.iloc[t].timestep-1, 
-                    'next_Score': subset.iloc[t].Score,
-                    'next_prompt': subset.iloc[t].prompt,
-                    'next_prompt_emb': subset.iloc[t]['prompt-embedding'],
-                    'next_prompt_kc': subset.iloc[t].kc_vec, # only in use when use_kc=True
-                    'next_code': subset.iloc[t].Code,
-                })
-                # set_trace()
+        # reorder the split so that each student's rows are contiguous, then build the rows in one pass
+        student_rows = group_rows_by_student(dataset_split.SubjectID)
+        order = np.concatenate(list(student_rows.values())) if student_rows else np.array([], dtype=np.int64)
+        subject_ids = dataset_split.SubjectID.to_numpy()[order]
+        problem_ids = dataset_split.ProblemID.to_numpy()[order]
+        steps = dataset_split.timestep.to_numpy()[order] - 1
+        scores = dataset_split.Score.to_numpy()[order]
+        prompts = dataset_split.prompt.to_numpy()[order]
+        prompt_embs = dataset_split['prompt-embedding'].to_numpy()[order]
+        kc_vecs = dataset_split.kc_vec.to_numpy()[order]
+        codes = dataset_split.Code.to_numpy()[order]
+        
+        # IMPORTANT: we want to predict the student's answer to the NEXT time step's question prompt
+        okt_dataset = [{
+            'SubjectID': student,
+            'ProblemID': problem_id, # key of the prompt table of OKTArrayDataset
+            'step': step, 
+            'next_Score': score,
+            'next_prompt': prompt,
+            'next_prompt_emb': prompt_emb,
+            'next_prompt_kc': kc_vec, # only in use when use_kc=True
+            'next_code': code,
+        } for student, problem_id, step, score, prompt, prompt_emb, kc_vec, code 
+          in zip(subject_ids, problem_ids, steps, scores, prompts, prompt_embs, kc_vecs, codes)]
         del dataset_split
         
         # dictionary, key=student id, value=list of lstm inputs at each time step
         if do_lstm_dataset:
             lstm_dataset = {}
-            students = dataset_full['SubjectID'].unique()
+            student_rows = group_rows_by_student(dataset_full.SubjectID)
             if configs.combine_method not in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
-                for student in students:
-                    if configs.kt_model == 'lstm':
-                        lstm_dataset[student]=dataset_full[dataset_full.SubjectID==student].input.tolist()
-                    elif configs.kt_model in {'akt', 'dkvmn'}:
-                        # get the q embedding matrix
-                        q_data_unique = np.unique(dataset_full.ProblemID.tolist()) # sorted, so deterministic
-                        q_data_unique = np.concatenate([[0], q_data_unique])
-                        q_dict = dict(zip(q_data_unique, np.arange(0, len(q_data_unique)))) # reserve 0 for padding
-                        # get the c embedding matrix
-                        cs_data_unique = dataset_full.CodeStateID.unique().tolist() # follows the dataset order
-                        cs_data_unique = ['0'] + cs_data_unique
-                        c_dict = dict(zip(cs_data_unique, np.arange(0, len(cs_data_unique)))) # reserve 0 for padding
-                        # get the student's question sequence, padding with 0
-                        q_data = dataset_full[dataset_full.SubjectID==student].ProblemID.tolist()
-                        q_data = q_data + (configs.max_len - len(q_data)) * [0]
-                        q_data = [q_dict[q] for q in q_data]
-                        # get the student's code state sequence, padding with '0'
-                        c_data = dataset_full[dataset_full.SubjectID==student].CodeStateID.tolist()
-                        c_data = c_data + (configs.max_len - len(c_data)) * ['0']
-                        c_data = [c_dict[c] for c in c_data]
-                        lstm_dataset[student] = {'q_data': q_data, 'c_data': c_data}
+                if configs.kt_model == 'lstm':
+                    inputs = dataset_full.input.to_numpy()
+                    for student, rows in student_rows.items():
+                        lstm_dataset[student] = inputs[rows].tolist()
+                elif configs.kt_model in {'akt', 'dkvmn'}:
+                    # get the q embedding matrix
+                    q_data_unique = np.unique(dataset_full.ProblemID.tolist()) # sorted, so deterministic
+                    q_data_unique = np.concatenate([[0], q_data_unique])
+                    q_dict = dict(zip(q_data_unique, np.arange(0, len(q_data_unique)))) # reserve 0 for padding
+                    # get the c embedding matrix
+                    cs_data_unique = dataset_full.CodeStateID.unique().tolist() # follows the dataset order
+                    cs_data_unique = ['0'] + cs_data_unique
+                    c_dict = dict(zip(cs_data_unique, np.arange(0, len(cs_data_unique)))) # reserve 0 for padding
+                    
+                    # question and code state sequences of all students, one row per student, 
+                    # padding with the ids of 0 and '0'
+                    lengths = np.array([len(rows) for rows in student_rows.values()])
+                    assert(lengths.max() <= configs.max_len)
+                    q_data = np.full((len(student_rows), configs.max_len), q_dict[0], dtype=np.int64)
+                    c_data = np.full((len(student_rows), configs.max_len), c_dict['0'], dtype=np.int64)
+                    order = np.concatenate(list(student_rows.values()))
+                    student_idx = np.repeat(np.arange(len(lengths)), lengths)
+                    positions = np.arange(len(order)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+                    q_data[student_idx, positions] = dataset_full.ProblemID.map(q_dict).to_numpy()[order]
+                    c_data[student_idx, positions] = dataset_full.CodeStateID.map(c_dict).to_numpy()[order]
+                    
+                    # each student's entry is a view into the shared arrays; 
+                    # 'row' lets a batch gather its sequences from q_data_all/c_data_all in one indexing op
+                    for row, student in enumerate(student_rows):
+                        lstm_dataset[student] = {'q_data': q_data[row], 'c_data': c_data[row], 'row': row,
+                                                 'q_data_all': q_data, 'c_data_all': c_data}
             else:
-                for student in students:
-                    assert(len(dataset_full[dataset_full.SubjectID==student]) <= configs.max_len)
-                    lstm_dataset[student]={'code_emb': dataset_full[dataset_full.SubjectID==student].embedding.tolist(),
-                                            'prompt_kc': dataset_full[dataset_full.SubjectID==student].kc_vec.tolist(),
+                code_embs = dataset_full.embedding.to_numpy()
+                kc_vecs = dataset_full.kc_vec.to_numpy()
+                for student, rows in student_rows.items():
+                    assert(len(rows) <= configs.max_len)
+                    lstm_dataset[student]={'code_emb': code_embs[rows].tolist(),
+                                            'prompt_kc': kc_vecs[rows].tolist(),
                                         }
             del dataset_full
             return okt_dataset, lstm_dataset
@@ -197,54 +321,391 @@ def make_pytorch_dataset(dataset_split, dataset_full, students, configs, do_lstm
             return okt_dataset
 
 
-def make_dataloader(dataset_split, dataset_full, students, collate_fn, configs, n_workers=0, do_lstm_dataset=True, train=True):
+def pretokenize_okt_dataset(okt_dataset, tokenizer):
     '''
-    if lstm, make standard dataset with a list of dict
-    if okt , make two datasets: one with a list of dict (for GPT), and another a dict with student_id as key (for LSTM to compute knowledge states)
+    tokenize every row's generator input (prompt + EOS + code + EOS) once, so that CollateForOKT
+    only slices and pads. adds to each row:
+        'input_ids' : int32 view into one flat token buffer shared by the whole split
+        'prompt_len': number of prompt tokens, i.e. the position of the first EOS
+        'label_end' : position of the last label token, i.e. the second EOS, or the last
+                      token when the code is truncated to the maximum length
+    the labels of a row are input_ids[prompt_len+1 : label_end+1]
+    every distinct prompt is tokenized once; the EOS is a special token, so the text on either 
+    side of it is tokenized independently and prompt + code can be tokenized apart
     '''
+    if len(okt_dataset) == 0:
+        return okt_dataset
+    prompts = list({b['next_prompt']: None for b in okt_dataset})
+    prompt_ids = dict(zip(prompts, tokenizer([prompt_proc_func(p) for p in prompts])['input_ids']))
+    code_ids = tokenizer([code_proc_func(b['next_code'], tokenizer) for b in okt_dataset])['input_ids']
+    # truncation=True in the tokenizer call, applied to the joined sequence
+    input_ids = [(prompt_ids[b['next_prompt']] + ids)[:tokenizer.model_max_length] for b, ids in zip(okt_dataset, code_ids)]
+    offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in input_ids])])
+    buffer = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int32, count=offsets[-1])
     
+    eos = tokenizer.eos_token_id
+    for i, (b, ids) in enumerate(zip(okt_dataset, input_ids)):
+        prompt_len = ids.index(eos)
+        label_end = ids.index(eos, prompt_len+1) if eos in ids[prompt_len+1:] else len(ids)-1
+        b['input_ids'] = buffer[offsets[i]:offsets[i+1]]
+        b['prompt_len'] = prompt_len
+        b['label_end'] = label_end
+    return okt_dataset
+
+
+def build_dataloader(pytorch_dataset, collate_fn, configs, n_workers=None, train=True):
+    '''
+    wrap a dataset made by make_pytorch_dataset (or loaded by prepare_data) into a pytorch dataloader
+    for okt, configs.batch_sampler='length_bucket' batches pre-tokenized samples of similar length,
+    'student' batches several timesteps of the same student together, and
+    configs.max_tokens_per_batch packs them up to a token budget instead of batch_size samples
+    @param n_workers: No. loading processes; defaults to configs.num_workers (see loader_kwargs)
+    '''
     shuffle = True if train else False
+    kwargs = loader_kwargs(pytorch_dataset, collate_fn, configs, n_workers)
+    if isinstance(pytorch_dataset, torch.utils.data.IterableDataset):
+        # streamed datasets shuffle and shard across workers themselves (see codenet_stream.py)
+        return torch.utils.data.DataLoader(pytorch_dataset, batch_size=configs.batch_size, **kwargs)
+    if configs.data_for == 'okt' and configs.get('max_tokens_per_batch'):
+        batch_sampler = TokenBudgetBatchSampler(token_lengths(pytorch_dataset), configs.max_tokens_per_batch, 
+                                                shuffle=shuffle, bucket_size=configs.batch_size*configs.bucket_size_multiplier)
+        return torch.utils.data.DataLoader(pytorch_dataset, batch_sampler=batch_sampler, **kwargs)
+    if configs.data_for == 'okt' and configs.get('batch_sampler', 'random') == 'student':
+        batch_sampler = StudentGroupedBatchSampler(student_indices(pytorch_dataset), configs.batch_size,
+                                                   group_size=configs.get('student_group_size', 4), shuffle=shuffle)
+        return torch.utils.data.DataLoader(pytorch_dataset, batch_sampler=batch_sampler, **kwargs)
+    if configs.data_for == 'okt' and configs.get('batch_sampler', 'random') == 'length_bucket':
+        batch_sampler = LengthBucketBatchSampler(token_lengths(pytorch_dataset), configs.batch_size, 
+                                                 shuffle=shuffle, bucket_size_multiplier=configs.bucket_size_multiplier)
+        return torch.utils.data.DataLoader(pytorch_dataset, batch_sampler=batch_sampler, **kwargs)
+    return torch.utils.data.DataLoader(pytorch_dataset, shuffle=shuffle, batch_size=configs.batch_size, **kwargs)
+
+
+def set_loader_epoch(dataloader, epoch):
+    '''
+    tell the batch sampler (see LengthBucketBatchSampler) or the streamed dataset (see 
+    codenet_stream.py) of a dataloader made by build_dataloader which epoch comes next, so it 
+    plans its shuffle; call before len(dataloader) and before iterating the epoch
+    '''
+    for planner in [dataloader.batch_sampler, dataloader.dataset]:
+        if hasattr(planner, 'set_epoch'):
+            planner.set_epoch(epoch)
+
+
+def token_lengths(okt_dataset):
+    '''
+    No. tokens of every pre-tokenized okt sample
+    '''
+    if isinstance(okt_dataset, OKTArrayDataset):
+        return okt_dataset.token_lengths()
+    return [len(b['input_ids']) for b in okt_dataset]
+
+
+def student_indices(okt_dataset):
+    '''
+    handle of the student of every okt sample
+    '''
+    if isinstance(okt_dataset, OKTArrayDataset):
+        return okt_dataset.student_idx
+    return np.unique([b['SubjectID'] for b in okt_dataset], return_inverse=True)[1]
+
+
+def loader_kwargs(pytorch_dataset, collate_fn, configs, n_workers=None):
+    '''
+    dataloader options shared by build_dataloader. with configs.num_workers > 0, batches are 
+    collated in worker processes while the training step runs:
+        prefetch_factor    : batches loaded ahead by each worker
+        persistent_workers : keep the workers (and their tokenizers) alive across epochs
+        pin_memory         : collate into page-locked memory for faster copies to the GPU
+    every worker starts with its own copy of the tokenizer (see WorkerInitForOKT)
+    '''
+    n_workers = configs.get('num_workers', 0) if n_workers is None else n_workers
+    kwargs = {'collate_fn': collate_fn, 'num_workers': n_workers, 'pin_memory': bool(configs.get('pin_memory', False))}
+    if n_workers > 0:
+        kwargs['worker_init_fn'] = WorkerInitForOKT(collate_fn)
+        kwargs['prefetch_factor'] = configs.get('prefetch_factor', 2)
+        # a persistent copy of a streamed dataset would not see set_epoch, so streams restart their workers
+        kwargs['persistent_workers'] = bool(configs.get('persistent_workers', True)) and \
+                                       not isinstance(pytorch_dataset, torch.utils.data.IterableDataset)
+    return kwargs
+
+
+def reload_tokenizer(tokenizer):
+    '''
+    a fresh copy of the tokenizer; the rust backend of a fast tokenizer is rebuilt, 
+    so a worker does not use the state it inherited from the forked parent
+    '''
+    return pickle.loads(pickle.dumps(tokenizer))
+
+
+class WorkerInitForOKT(object):
+    '''
+    worker_init_fn: reload the tokenizers of the collate function and of the dataset (if any)
+    inside the worker, single-threaded since the workers already tokenize in parallel.
+    this replaces relying on TOKENIZERS_PARALLELISM=false being set before the fork (see eval.py)
+    '''
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+        
+    def __call__(self, worker_id):
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+        if getattr(self.collate_fn, 'tokenizer', None) is not None:
+            self.collate_fn.tokenizer = reload_tokenizer(self.collate_fn.tokenizer)
+        dataset = torch.utils.data.get_worker_info().dataset
+        if getattr(dataset, 'tokenizer', None) is not None:
+            dataset.tokenizer = reload_tokenizer(dataset.tokenizer)
+
+
+def make_dataloader(dataset_split, dataset_full, students, collate_fn, configs, n_workers=None, do_lstm_dataset=True, train=True):
+    '''
+    if lstm, make standard dataset with a list of dict
+    if okt , make two datasets: one with a list of dict (for GPT), and another a dict with student_id as key (for LSTM to compute knowledge states)
+    '''
     
     ## make these sets into pytorch dataset format (list of dicts)
     if configs.data_for == 'lstm':
         lstm_dataset = make_pytorch_dataset(dataset_split, dataset_full, students, configs)
-        data_loader = torch.utils.data.DataLoader(
-            lstm_dataset, collate_fn=collate_fn, shuffle=shuffle, batch_size=configs.batch_size, num_workers=n_workers)    
+        data_loader = build_dataloader(lstm_dataset, collate_fn, configs, n_workers, train)
         return data_loader
      
     elif configs.data_for == 'okt':
         if do_lstm_dataset:
             okt_dataset, lstm_dataset = make_pytorch_dataset(dataset_split, dataset_full, None, configs, do_lstm_dataset)
-            data_loader = torch.utils.data.DataLoader(
-                okt_dataset, collate_fn=collate_fn, shuffle=shuffle, batch_size=configs.batch_size, num_workers=n_workers)   
+            data_loader = build_dataloader(okt_dataset, collate_fn, configs, n_workers, train)
             return okt_dataset, data_loader, lstm_dataset
         else:
             okt_dataset = make_pytorch_dataset(dataset_split, dataset_full, None, configs, do_lstm_dataset)
-            data_loader = torch.utils.data.DataLoader(
-                okt_dataset, collate_fn=collate_fn, shuffle=shuffle, batch_size=configs.batch_size, num_workers=n_workers)   
+            data_loader = build_dataloader(okt_dataset, collate_fn, configs, n_workers, train)
             return okt_dataset, data_loader
 
 
+def dataset_fingerprint(configs):
+    '''
+    (path, size, mtime) of every data file read_data reads, so that cached preprocessing
+    is invalidated when the dataset is converted, re-downloaded or edited
+    '''
+    columnar_dir = os.path.join(configs.data_path, COLUMNAR_DIRNAME)
+    if use_columnar_copy(configs.data_path):
+        paths = sorted(os.path.join(columnar_dir, f) for f in os.listdir(columnar_dir))
+    else:
+        paths = [os.path.join(configs.data_path, 'dataset.pkl')]
+    if configs.use_kc:
+        paths.append(os.path.join(configs.data_path, 'prompt_concept.xlsx'))
+    return [(os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in paths]
+
+
+def preprocess_cache_path(configs, tokenizer=None):
+    '''
+    cache file for the configs: a hash of the configs that change the output of
+    read_data/make_pytorch_dataset plus the dataset fingerprint (and the tokenizer, if pre-tokenized)
+    '''
+    key = {k: configs.get(k) for k in PREPROCESS_CACHE_KEYS}
+    key['dataset'] = dataset_fingerprint(configs)
+    key['version'] = PREPROCESS_CACHE_VERSION
+    if tokenizer is not None:
+        key['tokenizer'] = [tokenizer.name_or_path, len(tokenizer), tokenizer.eos_token_id, tokenizer.model_max_length]
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(configs.preprocess_cache_dir, '{}_{}.pt'.format(configs.data_for, digest))
+
+
+def prepare_data(configs, tokenizer=None):
+    '''
+    run read_data and make_pytorch_dataset for every split, cached on disk under 
+    configs.preprocess_cache_dir (set it to null to disable; never used when testing).
+    runs that only differ in e.g. learning rates or combine_weight share the cache.
+    for okt, passing the tokenizer also pre-tokenizes every split (see pretokenize_okt_dataset).
+    the splits are array-backed (see array_dataset.py), so forked dataloader workers share them.
+    @return: dict with the train/valid/test datasets, 
+             plus lstm_inputs, n_questions and n_solutions for okt
+    '''
+    use_cache = configs.get('preprocess_cache_dir') and not configs.testing
+    if use_cache:
+        cache_path = preprocess_cache_path(configs, tokenizer)
+        if os.path.exists(cache_path):
+            print('loading preprocessed data from {}'.format(cache_path))
+            return torch.load(cache_path, weights_only=False)
+    
+    if configs.data_for == 'lstm':
+        train_students, valid_students, test_students, dataset = read_data(configs)
+        data = {
+            'train': StudentArrayDataset(make_pytorch_dataset(None, dataset, train_students, configs)),
+            'valid': StudentArrayDataset(make_pytorch_dataset(None, dataset, valid_students, configs)),
+            'test' : StudentArrayDataset(make_pytorch_dataset(None, dataset, test_students, configs)),
+        }
+    elif configs.data_for == 'okt':
+        train_set, valid_set, test_set, dataset = read_data(configs)
+        train_dataset, lstm_inputs = make_pytorch_dataset(train_set, dataset, None, configs, do_lstm_dataset=True)
+        data = {
+            'train': train_dataset,
+            'valid': make_pytorch_dataset(valid_set, None, None, configs, do_lstm_dataset=False),
+            'test' : make_pytorch_dataset(test_set, None, None, configs, do_lstm_dataset=False),
+            'lstm_inputs': lstm_inputs,
+            # only needed by AKT/DKVMN
+            'n_questions': len(dataset.ProblemID.unique()) + 1,
+            'n_solutions': len(dataset.CodeStateID.unique()) + 1,
+        }
+        for split in ['train', 'valid', 'test']:
+            if tokenizer is not None:
+                pretokenize_okt_dataset(data[split], tokenizer)
+            data[split] = OKTArrayDataset(data[split])
+    
+    if use_cache:
+        os.makedirs(configs.preprocess_cache_dir, exist_ok=True)
+        # torch.save (unlike pickle) writes tensors that share storage only once
+        torch.save(data, cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+        print('saved preprocessed data to {}'.format(cache_path))
+    return data
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    '''
+    batch samples of similar token length so that fewer pad tokens go through the generator.
+    with shuffle, every epoch the samples are shuffled, split into buckets of 
+    batch_size * bucket_size_multiplier samples, sorted by length within each bucket and cut 
+    into batches, and the order of the batches is shuffled again. without shuffle, the batches 
+    are cut from all samples sorted by length.
+    uses the global torch RNG, like the default shuffling of the dataloader.
+    the number of batches can depend on the shuffle (see TokenBudgetBatchSampler), so an epoch is 
+    planned ahead: by set_epoch (see set_loader_epoch), or else by the first __len__ or by __iter__. 
+    __len__ always reports the planned epoch, also while it is being iterated, and never plans 
+    another one once the first is planned.
+    '''
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size_multiplier=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.batches = None # the planned epoch
+        self.iterated = False # whether __iter__ has started on the planned epoch
+        
+    def cut_batches(self, indices):
+        '''
+        cut indices sorted by length into batches
+        '''
+        return [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        
+    def plan_epoch(self):
+        if not self.shuffle:
+            return self.cut_batches(np.argsort(self.lengths, kind='stable'))
+        order = torch.randperm(len(self.lengths)).numpy()
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start+self.bucket_size]
+            batches += self.cut_batches(bucket[np.argsort(self.lengths[bucket], kind='stable')])
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        
+    def set_epoch(self, epoch):
+        '''
+        plan the batches of the coming epoch
+        '''
+        self.batches = self.plan_epoch()
+        self.iterated = False
+        
+    def __iter__(self):
+        # use the epoch planned by set_epoch or __len__, unless it has been iterated already
+        if self.batches is None or self.iterated:
+            self.batches = self.plan_epoch()
+        self.iterated = True
+        for batch in self.batches:
+            yield batch.tolist()
+    
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.plan_epoch()
+        return len(self.batches)
+
+
+class TokenBudgetBatchSampler(LengthBucketBatchSampler):
+    '''
+    length-bucketed batches with a variable number of samples: each batch is packed with 
+    samples until its padded size (No. samples * longest sample) would exceed max_tokens. 
+    a sample longer than max_tokens forms a batch on its own.
+    '''
+    def __init__(self, lengths, max_tokens, shuffle=True, bucket_size=400):
+        super().__init__(lengths, 1, shuffle=shuffle, bucket_size_multiplier=bucket_size)
+        self.max_tokens = max_tokens
+        
+    def cut_batches(self, indices):
+        batches, start, longest = [], 0, 0
+        for end, length in enumerate(self.lengths[indices]):
+            longest = max(longest, length)
+            if (end - start + 1) * longest > self.max_tokens and end > start:
+                batches.append(indices[start:end])
+                start, longest = end, length
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+
+class StudentGroupedBatchSampler(torch.utils.data.Sampler):
+    '''
+    batch several timesteps of the same student together, so that one lstm pass over the student's 
+    history gives the knowledge states of all of them (see get_knowledge_states_for_generator); 
+    with train_lstm this cuts the lstm work per batch by about group_size.
+    with shuffle, every epoch the samples of each student are shuffled and cut into groups of up to 
+    group_size, the groups are shuffled and the batches are cut from them in that order, so a batch 
+    of batch_size holds about batch_size / group_size students. without shuffle, the batches are cut 
+    from the samples sorted by student.
+    the gradient of a batch is the same as if every sample had its own lstm pass; what changes is 
+    the mix of a batch: its samples come from fewer students, so consecutive updates of the lstm 
+    and the generator are more correlated (group_size=1 gives the usual random batches).
+    uses the global torch RNG, like the default shuffling of the dataloader.
+    '''
+    def __init__(self, student_idx, batch_size, group_size=4, shuffle=True):
+        student_idx = np.asarray(student_idx)
+        order = np.argsort(student_idx, kind='stable')
+        self.student_rows = np.split(order, np.cumsum(np.bincount(student_idx))[:-1]) if len(order) else []
+        self.n_samples = len(order)
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.shuffle = shuffle
+        
+    def plan_epoch(self):
+        if not self.shuffle:
+            order = np.concatenate(self.student_rows) if self.n_samples else np.zeros(0, dtype=np.int64)
+        else:
+            groups = []
+            for rows in self.student_rows:
+                rows = rows[torch.randperm(len(rows)).numpy()]
+                groups += [rows[i:i+self.group_size] for i in range(0, len(rows), self.group_size)]
+            order = np.concatenate([groups[i] for i in torch.randperm(len(groups)).tolist()]) \
+                    if groups else np.zeros(0, dtype=np.int64)
+        return [order[i:i+self.batch_size] for i in range(0, len(order), self.batch_size)]
+        
+    def __iter__(self):
+        for batch in self.plan_epoch():
+            yield batch.tolist()
+    
+    def __len__(self):
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+
 class CollateForLSTM(object):
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
 
     def __call__(self, batch):
+        '''
+        pad the per-student [T, D] tensors into preallocated T*B*D batches, 
+        copying each student once
+        '''
+        lens = [len(b['Score']) for b in batch]
+        max_len = max(lens)
+        
         ## input padding for scores
-        scores = [b['Score'] for b in batch]
-        max_len = max(len(i) for i in scores)
-        padded_scores = [i + [-100]*(max_len-len(i)) for i in scores]
-        padded_scores = torch.tensor(padded_scores).float().t() # dim=T*B
+        padded_scores = torch.full((max_len, len(batch)), -100.) # dim=T*B
         
         ## input padding for lstm input
-        inputs = [b['input'] for b in batch]
-        padded_inputs = [i + [torch.zeros(i[0].shape[0])]*(max_len - len(i)) for i in inputs]
-        padded_inputs = torch.stack([torch.stack(x, dim=0) for x in padded_inputs], dim=1).float() # dim=T*B*D
+        padded_inputs = torch.zeros(max_len, len(batch), batch[0]['input'].shape[1]) # dim=T*B*D
         
         ## prompt embedding padding for output computation
-        prompt_embs = [b['prompt-embedding'] for b in batch]
-        padded_prompt_embs = [i + [torch.zeros(i[0].shape[0])]*(max_len - len(i)) for i in prompt_embs]
-        padded_prompt_embs = torch.stack([torch.stack(x, dim=0) for x in padded_prompt_embs], dim=1).float() # dim=T*B*D
+        padded_prompt_embs = torch.zeros(max_len, len(batch), batch[0]['prompt-embedding'].shape[1]) # dim=T*B*D
+        
+        for i, (b, length) in enumerate(zip(batch, lens)):
+            padded_scores[:length, i] = b['Score']
+            padded_inputs[:length, i] = b['input']
+            padded_prompt_embs[:length, i] = b['prompt-embedding']
         
         return padded_inputs, padded_prompt_embs, padded_scores
     
@@ -254,7 +715,37 @@ class CollateForOKT(object):
         self.tokenizer = tokenizer
         self.configs = configs
         
+    def pad_pretokenized(self, batch):
+        '''
+        batch the rows tokenized by pretokenize_okt_dataset: right-pad the input ids with the pad token 
+        and build the attention mask and the code labels, without calling the tokenizer
+        '''
+        lens = torch.tensor([len(b['input_ids']) for b in batch])
+        positions = torch.arange(int(lens.max())).unsqueeze(0) # 1*T
+        attention_mask = (positions < lens.unsqueeze(1)).long() # B*T
+        generator_inputs_ids = torch.full(attention_mask.shape, self.tokenizer.pad_token_id, dtype=torch.long)
+        generator_inputs_ids[attention_mask.bool()] = torch.from_numpy(np.concatenate([b['input_ids'] for b in batch])).long()
+        
+        # labels; only for the code
+        prompt_id_lens = [b['prompt_len'] for b in batch]
+        labels = self.code_labels(generator_inputs_ids, torch.tensor(prompt_id_lens), torch.tensor([b['label_end'] for b in batch]))
+        return generator_inputs_ids, attention_mask, labels, prompt_id_lens
+    
+    @staticmethod
+    def code_labels(generator_inputs_ids, first_eos_id_location, second_eos_id_location):
+        '''
+        labels are the input ids at positions in (first_eos, second_eos] of each row and -100 elsewhere
+        '''
+        positions = torch.arange(generator_inputs_ids.shape[1]).unsqueeze(0) # 1*T
+        label_mask = (positions > first_eos_id_location.unsqueeze(1)) & (positions <= second_eos_id_location.unsqueeze(1))
+        return torch.where(label_mask, generator_inputs_ids, torch.tensor(-100))
+    
     def __call__(self, batch):
+        
+        ## rows pre-tokenized by pretokenize_okt_dataset only need padding
+        if 'input_ids' in batch[0]:
+            generator_inputs_ids, attention_mask, labels, prompt_id_lens = self.pad_pretokenized(batch)
+            return self.collate_rest(batch, generator_inputs_ids, attention_mask, labels, prompt_id_lens)
 
         ## get input prompts and turn them into embeddings, with padding
         generator_inputs_raw = [prompt_proc_func(b['next_prompt']) + code_proc_func(b['next_code'], self.tokenizer) for b in batch]
@@ -267,21 +758,23 @@ class CollateForOKT(object):
                 assert(attention_mask[i, len_tmp:].sum() == 0)
                 
         # find the length of the prompt; special attention paid to truncated code where no EOS token at the end.
-        # In that case we just use the length of the sequence as the length of the code
-        eos_id_locations = torch.where(generator_inputs_ids==self.tokenizer.eos_token_id)
-        first_eos_id_location = torch.zeros(generator_inputs_ids.shape[0]).long()
-        second_eos_id_location = torch.zeros(generator_inputs_ids.shape[0]).long()
-        for idx in range(generator_inputs_ids.shape[0]):
-            eos_idx = eos_id_locations[1][eos_id_locations[0]==idx]
-            first_eos_id_location[idx] = eos_idx[0]
-            second_eos_id_location[idx] = eos_idx[1] if len(eos_idx) > 1 else len(generator_inputs_ids[idx])-1
-        prompt_id_lens = [len(generator_inputs_ids[i][:first_eos_id_location[i]]) for i in range(len(first_eos_id_location))]
+        # In that case we just use the length of the sequence as the length of the code.
+        # counting the EOS tokens up to each position, the first EOS is at the number of positions 
+        # without any EOS before it, and likewise for the second
+        eos_counts = (generator_inputs_ids == self.tokenizer.eos_token_id).cumsum(dim=1)
+        first_eos_id_location = (eos_counts < 1).sum(dim=1)
+        second_eos_id_location = (eos_counts < 2).sum(dim=1).clamp(max=generator_inputs_ids.shape[1]-1)
+        prompt_id_lens = first_eos_id_location.tolist()
         
         # labels; only for the code
-        labels = torch.ones_like(generator_inputs_ids) * -100.
-        for idx in range(labels.shape[0]):
-            labels[idx, first_eos_id_location[idx]+1:second_eos_id_location[idx]+1] = generator_inputs_ids[idx, first_eos_id_location[idx]+1:second_eos_id_location[idx]+1]
+        labels = self.code_labels(generator_inputs_ids, first_eos_id_location, second_eos_id_location)
         
+        return self.collate_rest(batch, generator_inputs_ids, attention_mask, labels, prompt_id_lens)
+    
+    def collate_rest(self, batch, generator_inputs_ids, attention_mask, labels, prompt_id_lens):
+        '''
+        everything in the batch besides the generator input
+        '''
         if self.configs.testing:
             try:
                 assert(50257 not in labels)
@@ -299,14 +792,14 @@ class CollateForOKT(object):
         padded_correctness = torch.tensor(correctness).float()
 
         ## next prompt embeddings
-        next_prompt_embs = torch.tensor([b['next_prompt_emb'] for b in batch]).float()
+        next_prompt_embs = torch.tensor(np.stack([b['next_prompt_emb'] for b in batch])).float()
         
         ## optional knowledge components
         if self.configs.use_kc:
             kc_vecs = torch.FloatTensor(np.stack([b['next_prompt_kc'] for b in batch]))            
-            return generator_inputs_ids, attention_mask, labels.long(), prompt_id_lens, students, timesteps, kc_vecs
+            return generator_inputs_ids, attention_mask, labels, prompt_id_lens, students, timesteps, kc_vecs
 
         if self.configs.use_classifier:
-            return generator_inputs_ids, attention_mask, labels.long(), prompt_id_lens, students, timesteps, padded_correctness, next_prompt_embs
+            return generator_inputs_ids, attention_mask, labels, prompt_id_lens, students, timesteps, padded_correctness, next_prompt_embs
 
-        return generator_inputs_ids, attention_mask, labels.long(), prompt_id_lens, students, timesteps
+        return generator_inputs_ids, attention_mask, labels, prompt_id_lens, students, timesteps
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped columnar storage for data/dataset.pkl.
+
+Layout of a converted dataset directory (default: data/dataset_columnar):
+    meta.json                 column names and kinds, and the size/mtime of the converted pickle
+    columns.pkl               small dataframe with the scalar columns (SubjectID, ProblemID, scores, ...)
+    <embedding>.npy           one contiguous [N, D] matrix per embedding column, float32 by default
+                              (float16, or bfloat16 stored as its int16 bit pattern, with --dtype)
+    <text>.offsets.npy        int64 [N+1] byte offsets of each row into <text>.bytes.npy
+    <text>.bytes.npy          uint8 buffer holding the utf-8 encoded rows back to back
+
+All .npy files are opened with np.load(mmap_mode='c'), so loading does not read the
+embeddings into memory and the pages are shared by every process that maps them.
+
+Convert once with
+    python dataset_store.py data/dataset.pkl data/dataset_columnar
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+
+COLUMNAR_DIRNAME = 'dataset_columnar'
+EMBEDDING_COLUMNS = ['prompt-embedding', 'embedding', 'input']
+TEXT_COLUMNS = ['Code', 'prompt']
+EMBEDDING_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def _is_scalar_column(column):
+    return column.map(pd.api.types.is_scalar).all()
+
+
+def pack_text(strings):
+    '''
+    utf-8 encode strings back to back into one uint8 buffer
+    @return: int64 offsets [N+1] and the buffer; string i is buffer[offsets[i]:offsets[i+1]]
+    '''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def unpack_text(offsets, buffer, i):
+    '''
+    decode string i of a buffer made by pack_text
+    '''
+    return buffer[offsets[i]:offsets[i+1]].tobytes().decode('utf-8')
+
+
+def pickle_signature(pkl_path):
+    '''
+    size and mtime of the pickle a columnar copy is converted from, see is_columnar_current
+    '''
+    st = os.stat(pkl_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def is_columnar_current(data_dir, pkl_path):
+    '''
+    whether the columnar copy in data_dir was converted from the pickle at pkl_path as it is now.
+    a copy without a pickle next to it is current; a copy converted before the signature was 
+    recorded cannot be checked and is treated as current
+    '''
+    if not os.path.exists(pkl_path):
+        return True
+    with open(os.path.join(data_dir, 'meta.json')) as f:
+        source = json.load(f).get('source')
+    return source is None or source == pickle_signature(pkl_path)
+
+
+def convert_pickle_to_columnar(pkl_path, out_dir, dtype='float32'):
+    '''
+    convert the pickled dataframe into the columnar layout described above.
+    nested object columns that training never reads (e.g. Code-ast, astnn) are dropped.
+    @param dtype: storage precision of the embedding columns, a key of EMBEDDING_DTYPES
+    '''
+    source = pickle_signature(pkl_path)
+    dataset = pd.read_pickle(pkl_path)
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {'n_rows': len(dataset), 'columns': [], 'embedding_columns': {}, 'text_columns': [],
+            'embedding_dtype': dtype, 'source': source}
+
+    for col in EMBEDDING_COLUMNS:
+        values = dataset[col].tolist()
+        # remember whether rows were stored as tensors so that loading restores the same types
+        kind = 'tensor' if isinstance(values[0], torch.Tensor) else 'array'
+        matrix = torch.from_numpy(np.stack([np.asarray(v, dtype=np.float32) for v in values])).to(EMBEDDING_DTYPES[dtype])
+        # numpy has no bfloat16; keep its bits
+        matrix = matrix.view(torch.int16).numpy() if dtype == 'bfloat16' else matrix.numpy()
+        np.save(os.path.join(out_dir, col + '.npy'), matrix)
+        meta['embedding_columns'][col] = kind
+
+    for col in TEXT_COLUMNS:
+        offsets, buffer = pack_text(dataset[col])
+        np.save(os.path.join(out_dir, col + '.offsets.npy'), offsets)
+        np.save(os.path.join(out_dir, col + '.bytes.npy'), buffer)
+        meta['text_columns'].append(col)
+
+    scalar_columns = [col for col in dataset.columns
+                      if col not in EMBEDDING_COLUMNS + TEXT_COLUMNS and _is_scalar_column(dataset[col])]
+    dataset[scalar_columns].to_pickle(os.path.join(out_dir, 'columns.pkl'))
+
+    meta['columns'] = [col for col in dataset.columns
+                       if col in scalar_columns or col in EMBEDDING_COLUMNS + TEXT_COLUMNS]
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_embedding_matrix(data_dir, col):
+    '''
+    memory-map one embedding column as an [N, D] matrix in its stored dtype (copy-on-write, so
+    torch.from_numpy works without copying or warnings); bfloat16 columns come back as int16
+    '''
+    return np.load(os.path.join(data_dir, col + '.npy'), mmap_mode='c')
+
+
+def load_text_column(data_dir, col):
+    '''
+    decode one text column from its offsets + bytes buffer into a list of str
+    '''
+    offsets = np.load(os.path.join(data_dir, col + '.offsets.npy'), mmap_mode='r').tolist()
+    buffer = np.load(os.path.join(data_dir, col + '.bytes.npy'), mmap_mode='r').tobytes()
+    return [buffer[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def load_columnar_dataset(data_dir):
+    '''
+    load a converted dataset as a dataframe with the same columns and row types as
+    dataset.pkl. embedding cells are views into the memory-mapped matrices, so no
+    embedding data is copied.
+    '''
+    with open(os.path.join(data_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    dataset = pd.read_pickle(os.path.join(data_dir, 'columns.pkl'))
+
+    dtype = meta.get('embedding_dtype', 'float32')
+    for col, kind in meta['embedding_columns'].items():
+        matrix = np.asarray(load_embedding_matrix(data_dir, col)) # plain ndarray view, no np.memmap rows
+        if dtype == 'bfloat16':
+            rows = torch.from_numpy(matrix).view(torch.bfloat16).unbind(0) # always tensors, see cast_embedding_columns
+        else:
+            rows = torch.from_numpy(matrix).unbind(0) if kind == 'tensor' else list(matrix)
+        dataset[col] = pd.Series(rows, index=dataset.index, dtype=object)
+    for col in meta['text_columns']:
+        dataset[col] = load_text_column(data_dir, col)
+
+    return dataset[meta['columns']]
+
+
+def stored_embedding_dtype(dataset):
+    '''
+    name (a key of EMBEDDING_DTYPES) of the precision the embedding rows are held in; float32 for 
+    the float32/float64 rows of the pickle
+    '''
+    if len(dataset) == 0:
+        return 'float32'
+    dtype = torch.as_tensor(dataset[EMBEDDING_COLUMNS[0]].iloc[0]).dtype
+    return {torch.float16: 'float16', torch.bfloat16: 'bfloat16'}.get(dtype, 'float32')
+
+
+def cast_embedding_columns(dataset, dtype):
+    '''
+    store every embedding column as one contiguous [N, D] matrix in dtype (float16 or bfloat16, 
+    or float32 for a reduced-precision columnar copy), with the rows as views into it. the batches 
+    upcast to float32.
+    numpy has no bfloat16, so bfloat16 rows are tensors; float16 rows keep their kind.
+    columns that already are in dtype are left alone.
+    '''
+    for col in EMBEDDING_COLUMNS:
+        values = dataset[col].tolist()
+        if len(values) == 0 or torch.as_tensor(values[0]).dtype == EMBEDDING_DTYPES[dtype]:
+            continue
+        matrix = torch.stack([torch.as_tensor(v) for v in values]).to(EMBEDDING_DTYPES[dtype])
+        if isinstance(values[0], torch.Tensor) or dtype == 'bfloat16':
+            rows = matrix.unbind(0)
+        else:
+            rows = list(matrix.numpy())
+        dataset[col] = pd.Series(rows, index=dataset.index, dtype=object)
+    return dataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert data/dataset.pkl into the memory-mapped columnar format read by read_data."
+    )
+    parser.add_argument("pkl_path", nargs="?", default="data/dataset.pkl",
+                        help="Path to the pickled dataset (default: %(default)s)")
+    parser.add_argument("out_dir", nargs="?", default=os.path.join("data", COLUMNAR_DIRNAME),
+                        help="Output directory (default: %(default)s)")
+    parser.add_argument("--dtype", choices=list(EMBEDDING_DTYPES), default="float32",
+                        help="Precision of the stored embeddings (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    meta = convert_pickle_to_columnar(args.pkl_path, args.out_dir, dtype=args.dtype)
+    print(f"Wrote {meta['n_rows']} rows ({len(meta['columns'])} columns) to {args.out_dir}.")
+
+
+if __name__ == "__main__":
+    main()
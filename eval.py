@@ -22,36 +22,27 @@ os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 from pdb import set_trace
 
 def generate_code(test_set, lstm_inputs, tokenizer, 
-                     idx, model, lstm, linear, weight, configs):
+                     idx, model, lstm, linear, weight, configs, ks_table=None, code_bank=None):
     
     # get the knowledge state
-    student, step, prompt, code = test_set[idx]['SubjectID'], test_set[idx]['step'], test_set[idx]['next_prompt'], test_set[idx]['next_code']
+    sample = test_set[idx]
+    student, step, prompt, code = sample['SubjectID'], sample['step'], sample['next_prompt'], sample['next_code']
     
     if configs.use_kc:
-        kc_vecs = torch.FloatTensor(test_set[idx]['next_prompt_kc']).unsqueeze(0)
+        kc_vecs = torch.FloatTensor(sample['next_prompt_kc']).unsqueeze(0)
     
-    ks, _ = get_knowledge_states_for_generator(lstm, lstm_inputs, [student], [step], configs)
+    ks, _ = get_knowledge_states_for_generator(lstm, lstm_inputs, [student], [step], configs, ks_table=ks_table, code_bank=code_bank)
     
-    # assemble generator input
-    tokenized_prompt = tokenizer(prompt_proc_func(prompt), return_tensors='pt')['input_ids']
+    # assemble generator input; pre-tokenized samples already hold the prompt tokens (see ProblemTable)
+    if 'input_ids' in sample:
+        tokenized_prompt = torch.from_numpy(sample['input_ids'][:sample['prompt_len']]).long().unsqueeze(0)
+    else:
+        tokenized_prompt = tokenizer(prompt_proc_func(prompt), return_tensors='pt')['input_ids']
     prompt_wte = model.transformer.wte(tokenized_prompt.cuda())
     
     # combine knowledge with generator input
-    for i in range(len([student])):
-        if configs.combine_method == 'add':
-            prompt_wte += configs.combine_weight * ks[i]
-        elif configs.combine_method == 'average':
-            prompt_wte = (prompt_wte + configs.combine_weight * ks[i]) / 2
-        elif configs.combine_method == 'weight':
-            prompt_wte += weight * ks[i]
-        elif configs.combine_method == 'linear':
-            if configs.use_kc:
-                assert(kc_vecs[i] is not None)
-                prompt_wte += linear( torch.cat((ks[i], kc_vecs[i].cuda()), dim=-1) )
-            else:
-                prompt_wte += linear(ks[i])  
-        elif configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
-            prompt_wte += linear(ks[i]) 
+    prompt_wte = combine_knowledge_states(prompt_wte, [prompt_wte.shape[1]], ks, linear, weight, configs,
+                                          kc_vecs=kc_vecs if configs.use_kc else None)
     
     # this aligns with training: the EOS token is not added with knowledge state 
     generator_input_emb = torch.cat((prompt_wte.squeeze(0), model.transformer.wte(torch.tensor([tokenizer.eos_token_id]).cuda())), dim=0) 
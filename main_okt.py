@@ -1,3 +1,4 @@
+import math
 import os
 import pickle
 from datetime import datetime
@@ -13,6 +14,7 @@ from collections import defaultdict
 import os
 
 from data_loader import *
+from codenet_stream import prepare_codenet_data
 from model import *
 from trainer import *
 from utils import *
@@ -53,28 +55,41 @@ def main(configs):
         os.mkdir(os.path.join(configs.model_save_dir, now))
 
 
-    ## load the init dataset
-    train_set, valid_set, test_set, dataset = read_data(configs)
+    ## load the preprocessed and pre-tokenized datasets (cached on disk, see prepare_data)
+    tokenizer = create_tokenizer(configs)
+    if configs.get('codenet_userdata'):
+        ## or stream the per-user CodeNet CSVs (see codenet_stream.py)
+        data = prepare_codenet_data(configs, tokenizer=tokenizer)
+    else:
+        data = prepare_data(configs, tokenizer=tokenizer)
+    lstm_inputs = data['lstm_inputs']
+    streamed = isinstance(data['train'], torch.utils.data.IterableDataset)
 
     ## uncomment this part when running for AKT
-    # configs.n_questions = len(dataset.ProblemID.unique()) + 1
-    # configs.n_solutions = len(dataset.CodeStateID.unique()) + 1
+    # configs.n_questions = data['n_questions']
+    # configs.n_solutions = data['n_solutions']
 
     ## load model
-    lstm, classifier, tokenizer, model, linear, weight = create_okt_model(configs)    
+    lstm, classifier, tokenizer, model, linear, weight = create_okt_model(configs, tokenizer)    
+
+    ## knowledge states of a frozen lstm or of exp_decay, computed once for all students
+    ks_table = None
+    if configs.get('precompute_knowledge_states') and not streamed:
+        if configs.use_lstm and configs.kt_model == 'lstm' and not configs.train_lstm:
+            ks_table = KnowledgeStateTable(lstm, lstm_inputs, configs)
+        elif not configs.use_lstm and configs.combine_method == 'exp_decay':
+            ks_table = ExpDecayKnowledgeStateTable(lstm_inputs, configs)
+
+    ## the code embeddings of all students on the device, for the combine methods without the lstm, 
+    ## unless ks_table already holds their knowledge states
+    ## (a stream builds the histories of its students as they come, see CodeNetHistories)
+    code_bank = CodeEmbeddingBank(lstm_inputs) if not configs.use_lstm and not streamed and ks_table is None else None
 
     ## load data
     collate_fn = CollateForOKT(tokenizer=tokenizer, configs=configs)
-    start = time.time()
-    _, train_loader, lstm_inputs = make_dataloader(train_set, dataset, None, 
-                                                   collate_fn=collate_fn, 
-                                                   configs=configs, do_lstm_dataset=True)
-    _, valid_loader = make_dataloader(valid_set, None, None, 
-                                      collate_fn=collate_fn, configs=configs, 
-                                      do_lstm_dataset=False, train=False)
-    _, test_loader  = make_dataloader(test_set , None, None, 
-                                      collate_fn=collate_fn, configs=configs, 
-                                      do_lstm_dataset=False, train=False)
+    train_loader = build_dataloader(data['train'], collate_fn, configs, train=True)
+    valid_loader = build_dataloader(data['valid'], collate_fn, configs, train=False)
+    test_loader  = build_dataloader(data['test'] , collate_fn, configs, train=False)
 
 
     ## optimizers and loss function
@@ -102,9 +117,17 @@ def main(configs):
     else:
         optimizers_lstm = None
 
-    ## scheduler
+    ## loss scaling for fp16 mixed precision, shared by all optimizers
+    scaler = make_grad_scaler(configs)
+
+    ## gradient accumulation: the optimizers step once every grad_accumulation_steps batches
+    accumulation_steps = configs.get('grad_accumulation_steps', 1)
+    n_train_batches = math.ceil(data['train'].n_samples() / configs.batch_size) if streamed else len(train_loader)
+    updates_per_epoch = math.ceil(n_train_batches / accumulation_steps)
+
+    ## scheduler; counts optimizer updates, so the warmup covers the same No. batches
     scheduler = transformers.get_linear_schedule_with_warmup(optimizer, 
-                        num_warmup_steps=1000, num_training_steps=configs.epochs*len(train_loader)*5)
+                        num_warmup_steps=math.ceil(1000 / accumulation_steps), num_training_steps=configs.epochs*updates_per_epoch*5)
 
 
     ## start training
@@ -114,13 +137,22 @@ def main(configs):
 
     for ep in range(configs.epochs):
         train_logs, test_logs, valid_logs = [], [], []
+        # real (non-pad) and total generator tokens, for the padding efficiency of the batching
+        train_tokens, valid_tokens = [0, 0], [0, 0]
         
         ## training
-        for idx, batch in enumerate(tqdm(train_loader)):
+        # plan the shuffle of the epoch, and fix its No. batches for the gradient accumulation
+        set_loader_epoch(train_loader, ep)
+        n_batches = None if streamed else len(train_loader)
+        for idx, batch in enumerate(tqdm(train_loader, total=n_batches)):
+            train_tokens[0] += batch[1].sum().item()
+            train_tokens[1] += batch[1].numel()
+            loss_scale, update = accumulation_window(idx, n_batches, accumulation_steps)
             train_log, model, linear, weight, lstm = generator_step(batch, lstm_inputs,
                                                         model, lstm, linear, weight,
                                                         optimizers_generator, optimizers_lstm,
-                                                        configs, train=True, scheduler=scheduler, classifier=classifier)
+                                                        configs, train=True, scheduler=scheduler, classifier=classifier, ks_table=ks_table, code_bank=code_bank,
+                                                        scaler=scaler, loss_scale=loss_scale, update=update)
             
             train_logs.append(train_log)
             ## save results to wandb
@@ -131,25 +163,33 @@ def main(configs):
                     for key in itr_train_logs:
                         log_dict["train_every_{}_itr/{}".format(configs.log_train_every_itr,key)] = itr_train_logs[key]
                     wandb.log(log_dict)
+        if n_batches is None and train_logs and len(train_logs) % accumulation_steps:
+            # the last window of a stream is only known to be incomplete at its end; drop its gradients
+            for optimizer in optimizers_generator + (optimizers_lstm or []):
+                optimizer.zero_grad()
             
         ## validation
         for idx, batch in enumerate(valid_loader):
+            valid_tokens[0] += batch[1].sum().item()
+            valid_tokens[1] += batch[1].numel()
             valid_log = generator_step(batch, lstm_inputs,
                                             model, lstm, linear, weight,
-                                            configs=configs, train=False, classifier=classifier)
+                                            configs=configs, train=False, classifier=classifier, ks_table=ks_table, code_bank=code_bank)
             valid_logs.append(valid_log)
             
         ## testing
         for idx, batch in enumerate(test_loader):
             test_log = generator_step(batch, lstm_inputs,
                                             model, lstm, linear, weight,
-                                            configs=configs, train=False, classifier=classifier)
+                                            configs=configs, train=False, classifier=classifier, ks_table=ks_table, code_bank=code_bank)
             test_logs.append(test_log)
         
         ## logging
         train_logs = aggregate_metrics(train_logs)
         valid_logs = aggregate_metrics(valid_logs)
         test_logs  = aggregate_metrics(test_logs )
+        train_logs['padding_efficiency'] = train_tokens[0] / train_tokens[1]
+        valid_logs['padding_efficiency'] = valid_tokens[0] / valid_tokens[1]
         print('train: ', train_logs)
         print('valid: ', valid_logs)
         print('test : ', test_logs )
@@ -211,16 +251,16 @@ def main(configs):
 
     ## one by one for testing
     configs.batch_size = 1
-    test_dataset, test_loader  = make_dataloader(test_set , None, None, 
-                                                    collate_fn=collate_fn, 
-                                                    configs=configs, do_lstm_dataset=False)
+    configs.max_tokens_per_batch = None
+    test_dataset = list(data['test']) if streamed else data['test']
+    test_loader  = build_dataloader(test_dataset, collate_fn, configs, n_workers=0, train=False)
     assert(len(test_loader) == len(test_dataset)) # pass one data point at a time. 
     generated_codes = []
     ground_truth_codes = []
     prompts = []
     for idx in range(len(test_dataset)):
         generated_code, nll, ground_truth_code, prompt = generate_code(test_dataset, lstm_inputs, tokenizer, 
-                                                                    idx, model, lstm, linear, weight, configs)
+                                                                    idx, model, lstm, linear, weight, configs, ks_table=ks_table, code_bank=code_bank)
         generated_codes.append(generated_code)
         ground_truth_codes.append(ground_truth_code)
         prompts.append(prompt)
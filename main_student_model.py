@@ -46,10 +46,10 @@ def main(configs):
     
     ## load data
     collate_fn = CollateForLSTM(None)
-    train_students, valid_students, test_students, dataset = read_data(configs)
-    train_loader = make_dataloader(None, dataset, train_students, collate_fn=collate_fn, configs=configs)
-    valid_loader = make_dataloader(None, dataset, valid_students, collate_fn=collate_fn, configs=configs, train=False)
-    test_loader  = make_dataloader(None, dataset, test_students,  collate_fn=collate_fn, configs=configs, train=False)
+    data = prepare_data(configs) # cached on disk, see prepare_data
+    train_loader = build_dataloader(data['train'], collate_fn, configs, train=True)
+    valid_loader = build_dataloader(data['valid'], collate_fn, configs, train=False)
+    test_loader  = build_dataloader(data['test'] , collate_fn, configs, train=False)
     
     ## load model
     lstm, classifier = create_lstm_model(configs)  
@@ -72,6 +72,8 @@ def main(configs):
         optimizers = [optimizer2]
     if configs.label_type == 'binary':
         loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
+    ## loss scaling for fp16 mixed precision
+    scaler = make_grad_scaler(configs)
         
 
     ## start training
@@ -89,7 +91,7 @@ def main(configs):
                                                     optimizers, loss_fn, train=True, 
                                                     init=configs.lstm_init,
                                                     use_scheduler=configs.use_scheduler, 
-                                                    schedulers=schedulers, configs=configs)
+                                                    schedulers=schedulers, configs=configs, scaler=scaler)
             train_logs.append(train_log)
 
         # validation
@@ -41,9 +41,10 @@ def create_tokenizer(configs):
     return tokenizer
 
 
-def create_okt_model(configs):
+def create_okt_model(configs, tokenizer=None):
     ## load the code generator model
-    tokenizer = create_tokenizer(configs)
+    if tokenizer is None:
+        tokenizer = create_tokenizer(configs)
     
     if configs.okt_model == 'student':
         model = AutoModelWithLMHead.from_pretrained("pretrained_lm/gpt_code_v1_student")
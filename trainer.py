@@ -1,10 +1,99 @@
+import contextlib
+
 import torch
 import numpy as np
-from sklearn.metrics import jaccard_score
+
+def mixed_precision_dtype(configs):
+    '''
+    dtype of configs.mixed_precision: 'bf16', 'fp16', 'auto' (fp16 on the GPU, bf16 on the CPU) 
+    or null for fp32 (None)
+    '''
+    precision = configs.get('mixed_precision')
+    if precision == 'auto':
+        precision = 'fp16' if torch.cuda.is_available() else 'bf16'
+    return {None: None, 'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+
+
+def autocast_context(configs):
+    '''
+    autocast the forward passes to the configs.mixed_precision dtype; the parameters, gradients and 
+    optimizer states stay fp32, so the optimizers and the weight/linear combiners need no changes
+    '''
+    dtype = mixed_precision_dtype(configs)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast('cuda' if torch.cuda.is_available() else 'cpu', dtype=dtype)
+
+
+def make_grad_scaler(configs):
+    '''
+    fp16 gradients can underflow, so fp16 training scales the loss with a GradScaler shared by all 
+    optimizers of a step (see step_optimizers); None for fp32 and bf16
+    '''
+    if mixed_precision_dtype(configs) != torch.float16:
+        return None
+    return torch.amp.GradScaler('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def backward(loss, scaler=None):
+    if scaler is not None:
+        scaler.scale(loss).backward()
+    else:
+        loss.backward()
+
+
+def step_optimizers(optimizers, scaler=None):
+    '''
+    step every optimizer; with a GradScaler each one is unscaled first and skipped on inf/nan gradients. 
+    call scaler.update() once after all optimizers of the step
+    '''
+    for optimizer in optimizers:
+        if scaler is not None:
+            scaler.step(optimizer)
+        else:
+            optimizer.step()
+
+
+def accumulation_window(idx, n_batches, accumulation_steps):
+    '''
+    gradient accumulation: the batches of an epoch are cut into windows of accumulation_steps (the 
+    last one may be shorter) and the optimizers step at the end of every window. returns the loss 
+    scale of batch idx, which averages the gradients of its window, and whether it ends the window.
+    n_batches must be the length of the epoch, read before iterating it; None for a stream of unknown 
+    length, whose last incomplete window gets no update (the caller clears its gradients)
+    '''
+    if n_batches is None:
+        return 1 / accumulation_steps, (idx + 1) % accumulation_steps == 0
+    window_start = idx // accumulation_steps * accumulation_steps
+    window = min(accumulation_steps, n_batches - window_start)
+    assert window > 0, 'batch {} of an epoch of {} batches'.format(idx, n_batches)
+    return 1 / window, idx + 1 == window_start + window
+
+
+def run_lstm(lstm, padded_lstm_ins, lengths, hidden, packed=True):
+    '''
+    run the lstm over inputs zero-padded at the end (T*B*D). with packed, the sequences are packed 
+    by length and the lstm does not step through the padding, so the work scales with sum(lengths) 
+    instead of T*B; the outputs at padded positions are then zeros instead of states of the padding, 
+    which are never read --> shape=T*B*D
+    @param lengths: No. real steps of every sequence; empty sequences get one step of padding
+    @param packed: configs.packed_lstm; pays off with cuDNN, while on CPU the padded lstm is faster
+    '''
+    if not packed:
+        return lstm(padded_lstm_ins, hidden)
+    lengths = torch.as_tensor(lengths, dtype=torch.long).cpu().clamp(min=1)
+    packed_lstm_ins = torch.nn.utils.rnn.pack_padded_sequence(padded_lstm_ins, lengths, enforce_sorted=False)
+    out, hidden = lstm(packed_lstm_ins, hidden)
+    out, _ = torch.nn.utils.rnn.pad_packed_sequence(out, total_length=padded_lstm_ins.shape[0])
+    return out, hidden
+
 
 def lstm_step(batch, lstm, classifier, hidden_dim, 
                     optimizers, loss_fn, train=True,
-                    init='rand', use_scheduler=True, schedulers=None, configs=None):
+                    init='rand', use_scheduler=True, schedulers=None, configs=None, scaler=None):
+    '''
+    scaler: GradScaler for fp16 mixed precision (see make_grad_scaler)
+    '''
     if train:
         if configs.lstm_train:
             lstm.train()
@@ -23,23 +112,26 @@ def lstm_step(batch, lstm, classifier, hidden_dim,
     elif init == 'zero':
         hidden_h, hidden_c = torch.zeros(1, lstm_inputs.shape[1], hidden_dim).cuda(), torch.zeros(1, lstm_inputs.shape[1], hidden_dim).cuda()
     
-    # pass through lstm
-    if configs.lstm_train:
-        out, hidden = lstm(lstm_inputs.cuda(), (hidden_h, hidden_c))
-    else:
-        with torch.no_grad():
-            out, hidden = lstm(lstm_inputs.cuda(), (hidden_h, hidden_c))
-    logits = classifier(torch.cat((out, prompt_embs.cuda()), dim=-1)).squeeze(-1)
-    
-    # compute stats
-    loss = loss_fn(logits[scores!=-100], scores[scores!=-100].cuda()).sum()
+    # pass through lstm; every student's inputs end one step before its last score
+    lengths = (batch[2] != -100).sum(0) - 1
+    with autocast_context(configs):
+        if configs.lstm_train:
+            out, hidden = run_lstm(lstm, lstm_inputs.cuda(), lengths, (hidden_h, hidden_c), packed=configs.get('packed_lstm', True))
+        else:
+            with torch.no_grad():
+                out, hidden = run_lstm(lstm, lstm_inputs.cuda(), lengths, (hidden_h, hidden_c), packed=configs.get('packed_lstm', True))
+        logits = classifier(torch.cat((out, prompt_embs.cuda()), dim=-1)).squeeze(-1).float()
+        
+        # compute stats
+        loss = loss_fn(logits[scores!=-100], scores[scores!=-100].cuda()).sum()
     if train:
-        ( loss / lstm_inputs.shape[1] ).backward()
+        backward( loss / lstm_inputs.shape[1], scaler )
     
     # optimization
     if train:
-        for optimizer in optimizers:
-            optimizer.step()
+        step_optimizers(optimizers, scaler)
+        if scaler is not None:
+            scaler.update()
         if use_scheduler:
             for scheduler in schedulers:
                 scheduler.step(loss / lstm_inputs.shape[1])
@@ -66,7 +158,15 @@ def lstm_step(batch, lstm, classifier, hidden_dim,
 def generator_step(batch, lstm_inputs,
                    model, lstm, linear, weight,
                    optimizers=None, optimizers_lstm=None, 
-                   configs=None, train=True, scheduler=None, classifier=None):
+                   configs=None, train=True, scheduler=None, classifier=None, ks_table=None, code_bank=None, scaler=None,
+                   loss_scale=1., update=True):
+    '''
+    scaler: GradScaler for fp16 mixed precision (see make_grad_scaler); the generator and the lstm 
+            optimizers are stepped through the same scaler, which is updated once per step
+    loss_scale, update: gradient accumulation over micro-batches (see main_okt.py); the loss is 
+            multiplied by loss_scale before backward, and the optimizers, the scheduler and the 
+            scaler only step (and the gradients are only cleared) when update is true
+    '''
     
     assert(configs!=None)        
     
@@ -99,34 +199,35 @@ def generator_step(batch, lstm_inputs,
     padded_correctness = batch[-2] if configs.use_classifier else None
     next_prompt_embs = batch[-1] if configs.use_classifier else None
     
-    generator_inputs_wte, ks = assemble_generator_input(model, lstm, linear, weight, configs,
-                                                    generator_inputs_ids, prompt_id_lens, 
-                                                    lstm_inputs, students, timesteps, kc_vecs=kc_vecs)
-    
-    # forward generator
-    if train:
-        outputs = model(inputs_embeds=generator_inputs_wte, attention_mask=attention_mask.cuda(), labels=labels.cuda())
-    else:
-        with torch.no_grad():
+    # the forward passes run in configs.mixed_precision (see autocast_context)
+    with autocast_context(configs):
+        generator_inputs_wte, ks = assemble_generator_input(model, lstm, linear, weight, configs,
+                                                        generator_inputs_ids, prompt_id_lens, 
+                                                        lstm_inputs, students, timesteps, kc_vecs=kc_vecs, ks_table=ks_table, code_bank=code_bank)
+        
+        # forward generator
+        if train:
             outputs = model(inputs_embeds=generator_inputs_wte, attention_mask=attention_mask.cuda(), labels=labels.cuda())
-    
-    # compute stats
-    loss = outputs[0]
-    
-    # compute correctness loss
-    if configs.use_classifier:
-        loss_fn = torch.nn.BCEWithLogitsLoss(reduction='mean')
-        logits = classifier(torch.cat((ks, next_prompt_embs.cuda()), dim=-1)).squeeze(-1)
-        loss_cls = loss_fn(logits[padded_correctness!=-100], padded_correctness[padded_correctness!=-100].cuda()).sum()
-        loss += loss_cls
+        else:
+            with torch.no_grad():
+                outputs = model(inputs_embeds=generator_inputs_wte, attention_mask=attention_mask.cuda(), labels=labels.cuda())
+        
+        # compute stats
+        loss = outputs[0].float()
+        
+        # compute correctness loss
+        if configs.use_classifier:
+            loss_fn = torch.nn.BCEWithLogitsLoss(reduction='mean')
+            logits = classifier(torch.cat((ks, next_prompt_embs.cuda()), dim=-1)).squeeze(-1)
+            loss_cls = loss_fn(logits[padded_correctness!=-100], padded_correctness[padded_correctness!=-100].cuda()).sum()
+            loss += loss_cls
     
     if train:
-        loss.backward()
+        backward(loss * loss_scale, scaler)
     
     # optimization
-    if train:
-        for optimizer in optimizers:
-            optimizer.step()
+    if train and update:
+        step_optimizers(optimizers, scaler)
         if configs.use_scheduler:
             scheduler.step()
         for optimizer in optimizers:
@@ -138,13 +239,20 @@ def generator_step(batch, lstm_inputs,
         # training the lstm
         if configs.train_lstm and configs.use_lstm:
             assert(optimizers_lstm != None)
-            for optimizer in optimizers_lstm:
-                optimizer.step()
+            step_optimizers(optimizers_lstm, scaler)
             for optimizer in optimizers_lstm:
                 optimizer.zero_grad()
             lstm.zero_grad()
+        if scaler is not None:
+            scaler.update()
     
     log = {'loss': loss.cpu().detach()}
+    if configs.get('max_tokens_per_batch'):
+        # the generator loss is already the mean over the label tokens of the batch; with a token 
+        # budget the batches differ in size, so weight each batch by its No. label tokens (the 
+        # model shifts the labels by one) in the epoch average, like the lstm weights by responses
+        n_label_tokens = int((labels[:, 1:] != -100).sum())
+        log = {'loss': loss.cpu().detach().repeat(max(n_label_tokens, 1))}
     
     if train:
         return log, model, linear, weight, lstm
@@ -154,161 +262,339 @@ def generator_step(batch, lstm_inputs,
 
 
 
-def get_knowledge_states_for_generator(lstm, lstm_inputs, students, timesteps, configs):
+def pad_lstm_inputs(lstm_ins):
+    '''
+    stack the lstm input sequences of a batch of students, zero-padded at the end --> shape=T*B*D
+    '''
+    max_len = max(len(i) for i in lstm_ins)
+    padded_lstm_ins = [i + [torch.zeros(i[0].shape[0], dtype=i[0].dtype)]*(max_len - len(i)) for i in lstm_ins]
+    return torch.stack([torch.stack(x, dim=0) for x in padded_lstm_ins], dim=1).float() # dim=T*B*D
+
+
+def init_lstm_hidden(batch_size, configs, device='cuda'):
+    '''
+    initial (h, c) of the knowledge-state lstm, following configs.lstm_init
+    '''
+    if configs.lstm_init == 'rand':
+        return torch.rand(1, batch_size, configs.lstm_hid_dim, device=device), torch.rand(1, batch_size, configs.lstm_hid_dim, device=device)
+    elif configs.lstm_init == 'zero':
+        return torch.zeros(1, batch_size, configs.lstm_hid_dim, device=device), torch.zeros(1, batch_size, configs.lstm_hid_dim, device=device)
+
+
+class KnowledgeStateTable(object):
+    '''
+    knowledge states of a frozen lstm (train_lstm=false) for every step of every student, computed 
+    once instead of rerunning the lstm over the padded histories of every batch.
+    student s's hidden states are rows offsets[s] : offsets[s]+T_s of states [N, D], so the 
+    knowledge state of (s, t) is states[offsets[s] + t].
+    the lstm is causal and the padding comes after the history, so with lstm_init='zero' the states 
+    are those of get_knowledge_states_for_generator; with 'rand' the random initial state is drawn 
+    once per student instead of once per batch.
+    @param batch_size: students per lstm pass while building the table (sorted by length)
+    @param device: where the table is kept, e.g. 'cuda', or 'cpu' to keep it in (shared) host memory
+    '''
+    def __init__(self, lstm, lstm_inputs, configs, batch_size=64, device='cuda'):
+        assert(configs.use_lstm and configs.kt_model == 'lstm' and not configs.train_lstm)
+        self.device = device
+        students = sorted(lstm_inputs, key=lambda s: len(lstm_inputs[s]))
+        lengths = np.array([len(lstm_inputs[s]) for s in students])
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.offsets = dict(zip(students, offsets[:-1].tolist()))
+        self.states = torch.empty(offsets[-1], configs.lstm_hid_dim, device=device)
+        
+        lstm_device = next(lstm.parameters()).device
+        lstm.eval()
+        with torch.no_grad():
+            for start in range(0, len(students), batch_size):
+                batch = students[start:start+batch_size]
+                padded_lstm_ins = pad_lstm_inputs([lstm_inputs[s] for s in batch])
+                out, hidden = run_lstm(lstm, padded_lstm_ins.to(lstm_device), lengths[start:start+batch_size],
+                                       init_lstm_hidden(len(batch), configs, lstm_device), packed=configs.get('packed_lstm', True)) # shape = T*B*D
+                for b, student in enumerate(batch):
+                    self.states[offsets[start+b]:offsets[start+b+1]] = out[:lengths[start+b], b].to(device)
+        if device == 'cpu':
+            self.states.share_memory_()
+    
+    def __call__(self, students, timesteps):
+        '''
+        knowledge states of a batch --> shape=B*D
+        '''
+        rows = torch.tensor([self.offsets[s] + int(t) for s, t in zip(students, timesteps)], device=self.device)
+        return self.states[rows]
+
+
+class CodeEmbeddingBank(object):
+    '''
+    the code embeddings of all responses of all students (lstm_inputs[s]['code_emb'], for the combine 
+    methods without the lstm) in one contiguous float32 tensor embs [N, D] on the training device, 
+    with index[s] = (offset, length): student s's responses are rows offset : offset+length.
+    built once, so batches gather from it instead of copying every history to the device.
+    '''
+    def __init__(self, lstm_inputs, device='cuda'):
+        self.device = device
+        students = list(lstm_inputs)
+        lengths = [len(lstm_inputs[s]['code_emb']) for s in students]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.index = {s: (int(offsets[i]), int(lengths[i])) for i, s in enumerate(students)}
+        self.embs = torch.cat([torch.stack([torch.as_tensor(e) for e in lstm_inputs[s]['code_emb']]).float()
+                               for s in students]).to(device)
+    
+    def rows(self, students, timesteps):
+        '''
+        row of every response up to timesteps[b] of every sample, padded with row 0 --> shape=B*T, 
+        and the mask of the real ones --> shape=B*T
+        '''
+        starts = torch.tensor([self.index[s][0] for s in students])
+        lens = torch.as_tensor(np.asarray(timesteps, dtype=np.int64)) + 1
+        positions = torch.arange(int(lens.max()))
+        mask = positions.unsqueeze(0) < lens.unsqueeze(1)
+        return torch.where(mask, starts.unsqueeze(1) + positions, torch.zeros_like(mask, dtype=torch.long)), mask
+
+
+class ExpDecayKnowledgeStateTable(KnowledgeStateTable):
+    '''
+    exp_decay knowledge states for every step of every student, as a KnowledgeStateTable.
+    the state at t is sum_i exp(-(t-i)) e_i / sum_i exp(-(t-i)) over the code embeddings e_0..e_t, 
+    and both sums follow the recurrence x_t = exp(-1) x_{t-1} + (e_t or 1), so every student's 
+    states take one O(T) pass (here over all students at once, one timestep at a time) instead of 
+    a weighted sum over the whole prefix for every sample of every batch.
+    '''
+    def __init__(self, lstm_inputs, configs, device='cuda'):
+        assert(configs.combine_method == 'exp_decay')
+        self.device = device
+        code_bank = CodeEmbeddingBank(lstm_inputs, device='cpu')
+        students = list(code_bank.index)
+        lengths = np.array([code_bank.index[s][1] for s in students])
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.offsets = {s: code_bank.index[s][0] for s in students}
+        code_embs = code_bank.embs.double().numpy()
+        
+        states = np.empty_like(code_embs)
+        weighted_sum = np.zeros((len(students), code_embs.shape[1])) # sum_i exp(-(t-i)) e_i
+        normalizer = np.zeros((len(students), 1)) # sum_i exp(-(t-i))
+        for t in range(lengths.max() if len(lengths) else 0):
+            active = lengths > t
+            rows = offsets[:-1][active] + t
+            weighted_sum[active] = np.exp(-1.) * weighted_sum[active] + code_embs[rows]
+            normalizer[active] = np.exp(-1.) * normalizer[active] + 1
+            states[rows] = weighted_sum[active] / normalizer[active]
+        self.states = torch.from_numpy(states).float().to(device)
+        if device == 'cpu':
+            self.states.share_memory_()
+
+
+def lstm_knowledge_states(lstm, lstm_inputs, students, timesteps, configs, device='cuda'):
+    '''
+    knowledge states of a batch from the lstm (kt_model 'lstm') --> ks shape=B*D, out shape=T*B'*D
+    every student of the batch goes through the lstm once, up to the latest timestep the batch needs 
+    (the lstm is causal), and the samples of a student share its column of out. with train_lstm the 
+    loss of each sample backpropagates into the shared prefix, which sums to the same gradient as one 
+    lstm pass per sample (see StudentGroupedBatchSampler)
+    '''
+    batch_students, columns = np.unique(students, return_inverse=True)
+    last_steps = np.zeros(len(batch_students), dtype=np.int64)
+    np.maximum.at(last_steps, columns, np.asarray(timesteps, dtype=np.int64))
+    padded_lstm_ins = pad_lstm_inputs([lstm_inputs[s][:t+1] for s, t in zip(batch_students, last_steps)]) # dim=T*B'*D
+    hidden_h, hidden_c = init_lstm_hidden(padded_lstm_ins.shape[1], configs, device)
+    if configs.train_lstm:
+        out, hidden = run_lstm(lstm, padded_lstm_ins.to(device), last_steps + 1, (hidden_h, hidden_c),
+                               packed=configs.get('packed_lstm', True)) # shape = T*B'*D
+    else:
+        with torch.no_grad():
+            out, hidden = run_lstm(lstm, padded_lstm_ins.to(device), last_steps + 1, (hidden_h, hidden_c),
+                               packed=configs.get('packed_lstm', True)) # shape = T*B'*D
+    ks = out[torch.as_tensor(timesteps, dtype=torch.long), torch.from_numpy(columns), :] # extract the hidden states --> shape=B*D
+    return ks, out
+
+
+def kc_similarity(lstm_inputs, student):
+    '''
+    pairwise jaccard similarity (as sklearn's jaccard_score, 0 when neither has a KC) of the KC vectors 
+    of all responses of a student --> shape=T*T, from binary matrix products. computed once per student 
+    and kept in lstm_inputs[student]['kc_sim'] for the rest of the run
+    '''
+    student_inputs = lstm_inputs[student]
+    if 'kc_sim' not in student_inputs:
+        kcs = (np.stack(student_inputs['prompt_kc']) > 0).astype(np.float64) # T*K
+        intersection = kcs @ kcs.T
+        sizes = kcs.sum(1)
+        union = sizes[:, None] + sizes[None, :] - intersection
+        student_inputs['kc_sim'] = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+    return student_inputs['kc_sim']
+
+
+def decay_knowledge_states(code_bank, lstm_inputs, students, timesteps, configs):
+    '''
+    knowledge states of the combine methods without the lstm: the code embeddings of every response 
+    up to t, weighted by configs.combine_method and summed --> shape=B*D
+        no_decay     : the code embedding at t
+        exp_decay    : weights exp(-(t-i)), normalized
+        kc_sim_decay : jaccard similarity of the KCs at i with the KCs of the prompt at t+1 (see 
+                       kc_similarity), normalized unless all 0
+        exp_kc_decay : the product of both, normalized unless all 0
+    the histories are gathered from code_bank (a CodeEmbeddingBank) and the weights of the batch are 
+    built on the host as one zero-padded B*T matrix, so the sum is a single bmm on the device
+    '''
+    rows, mask = code_bank.rows(students, timesteps) # B*T
+    if configs.combine_method == 'no_decay':
+        last = mask.sum(1) - 1
+        return code_bank.embs[rows[torch.arange(len(students)), last].to(code_bank.device)]
+    
+    def normalize(w):
+        total = w.sum(1, keepdims=True)
+        return np.divide(w, total, out=np.zeros_like(w), where=total != 0) # do not normalize 0
+    
+    lens = mask.sum(1).numpy()
+    positions = np.arange(mask.shape[1])
+    if 'exp_' in configs.combine_method:
+        # exponential decay for each student, up til t
+        exp_weights = normalize(np.where(mask.numpy(), np.exp(-(lens[:, None] - 1 - positions[None, :])), 0.))
+    if 'kc_' in configs.combine_method:
+        kc_weights = np.zeros(mask.shape)
+        for b in range(len(timesteps)):
+            kc_weights[b, :lens[b]] = kc_similarity(lstm_inputs, students[b])[timesteps[b]+1, :timesteps[b]+1]
+        kc_weights = normalize(kc_weights)
+    
+    if configs.combine_method == 'exp_decay':
+        weights = exp_weights
+    elif configs.combine_method == 'kc_sim_decay':
+        weights = kc_weights
+    elif configs.combine_method == 'exp_kc_decay':
+        weights = normalize(exp_weights * kc_weights)
+    weights = torch.from_numpy(weights).float().unsqueeze(1).to(code_bank.device) # B*1*T
+    code_embs = code_bank.embs[rows.to(code_bank.device)] # B*T*D
+    return torch.bmm(weights, code_embs).squeeze(1)
+
+
+def get_knowledge_states_for_generator(lstm, lstm_inputs, students, timesteps, configs, ks_table=None, code_bank=None):
     '''
     used during ***inference (generation) time*** to get a student's knowledge state
+    ks_table: a KnowledgeStateTable of the frozen lstm (or ExpDecayKnowledgeStateTable); the states are 
+              looked up instead of recomputed
+    code_bank: a CodeEmbeddingBank of lstm_inputs, for the combine methods without the lstm
     '''
-    if configs.use_lstm:
+    if ks_table is not None:
+        return ks_table(students, timesteps).cuda(), None
+    
+    if configs.use_lstm and configs.kt_model == 'lstm':
+        ks, out = lstm_knowledge_states(lstm, lstm_inputs, students, timesteps, configs)
+    
+    elif configs.use_lstm:
         # get lstm inputs
         lstm_ins = [lstm_inputs[s] for s in students]
-        if configs.kt_model == 'lstm':
-            max_len = max(len(i) for i in lstm_ins)
-            padded_lstm_ins = [i + [torch.zeros(i[0].shape[0])]*(max_len - len(i)) for i in lstm_ins]
-            padded_lstm_ins = torch.stack([torch.stack(x, dim=0) for x in padded_lstm_ins], dim=1).float() # dim=T*B*D
         
         # get knowledge states
-        if configs.kt_model == 'lstm':
-            if configs.lstm_init == 'rand':
-                hidden_h, hidden_c = torch.rand(1, padded_lstm_ins.shape[1], configs.lstm_hid_dim).cuda(), torch.rand(1, padded_lstm_ins.shape[1], configs.lstm_hid_dim).cuda()
-            elif configs.lstm_init == 'zero':
-                hidden_h, hidden_c = torch.zeros(1, padded_lstm_ins.shape[1], configs.lstm_hid_dim).cuda(), torch.zeros(1, padded_lstm_ins.shape[1], configs.lstm_hid_dim).cuda()
-                
         if configs.train_lstm:
-            if configs.kt_model == 'lstm':
-                out, hidden = lstm(padded_lstm_ins.cuda(), (hidden_h, hidden_c)) # shape = T*B*D
+            rows = [l['row'] for l in lstm_ins]
+            input_q = torch.from_numpy(lstm_ins[0]['q_data_all'][rows]).long().cuda()
+            input_c = torch.from_numpy(lstm_ins[0]['c_data_all'][rows]).long().cuda()
+            if configs.kt_model == 'dkvmn':
+                input_q = torch.transpose(input_q, 0,1) # seqlen, BS
+                input_c = torch.transpose(input_c, 0,1)
+            with torch.no_grad():
+                q_embed_data = lstm.q_embed(input_q)  # BS, seqlen, d_model#, c_ct
+            qa_embed_data = lstm.qa_embed(input_c)
             
-            else:
-                input_q = np.vstack([l['q_data'] for l in lstm_ins])
-                input_c = np.vstack([l['c_data'] for l in lstm_ins])
-                input_q = torch.from_numpy(input_q).long().cuda()
-                input_c = torch.from_numpy(input_c).long().cuda()
-                if configs.kt_model == 'dkvmn':
-                    input_q = torch.transpose(input_q, 0,1) # seqlen, BS
-                    input_c = torch.transpose(input_c, 0,1)
-                with torch.no_grad():
-                    q_embed_data = lstm.q_embed(input_q)  # BS, seqlen, d_model#, c_ct
-                qa_embed_data = lstm.qa_embed(input_c)
-                
-                if configs.kt_model == 'akt':
-                    qa_embed_data = lstm.linear_qa(qa_embed_data)
-                    out = lstm.model(q_embed_data, qa_embed_data)  # 211x512
-                    out = torch.transpose(out, 0, 1)
+            if configs.kt_model == 'akt':
+                qa_embed_data = lstm.linear_qa(qa_embed_data)
+                out = lstm.model(q_embed_data, qa_embed_data)  # 211x512
+                out = torch.transpose(out, 0, 1)
 
+            elif configs.kt_model == 'dkvmn':
+                memory_value = lstm.init_memory_value[None, :, :].expand(input_q.shape[1], -1, -1)
+                init_memory_key = lstm.init_memory_key
+                lstm.seqlen = input_q.size(0)
+                mem = lstm.memory
+                value_read_content_l = []
+                input_embed_l = []
+                for i in range(lstm.seqlen):
+                    # Attention
+                    q = q_embed_data[i]
+                    correlation_weight = mem.attention(q, init_memory_key)
+
+                    # Read Process
+                    # Shape (batch_size, memory_state_dim)
+                    read_content = mem.read(memory_value, correlation_weight)
+
+                    # set_trace()
+                    # save intermedium data
+                    value_read_content_l.append(read_content[None, :, :])
+                    input_embed_l.append(q[None, :, :])
+
+                    # Write Process
+                    qa = qa_embed_data[i]
+                    memory_value = mem.write(qa, memory_value, correlation_weight)
+
+                all_read_value_content = torch.cat(value_read_content_l, dim=0)
+                if configs.kt_model == 'akt':
+                    out = torch.transpose(all_read_value_content, 0, 1) # seqlen, BS, dim
                 elif configs.kt_model == 'dkvmn':
-                    memory_value = lstm.init_memory_value[None, :, :].expand(input_q.shape[1], -1, -1)
-                    init_memory_key = lstm.init_memory_key
-                    lstm.seqlen = input_q.size(0)
-                    mem = lstm.memory
-                    value_read_content_l = []
-                    input_embed_l = []
-                    for i in range(lstm.seqlen):
-                        # Attention
-                        q = q_embed_data[i]
-                        correlation_weight = mem.attention(q, init_memory_key)
-
-                        # Read Process
-                        # Shape (batch_size, memory_state_dim)
-                        read_content = mem.read(memory_value, correlation_weight)
-
-                        # set_trace()
-                        # save intermedium data
-                        value_read_content_l.append(read_content[None, :, :])
-                        input_embed_l.append(q[None, :, :])
-
-                        # Write Process
-                        qa = qa_embed_data[i]
-                        memory_value = mem.write(qa, memory_value, correlation_weight)
-
-                    all_read_value_content = torch.cat(value_read_content_l, dim=0)
-                    if configs.kt_model == 'akt':
-                        out = torch.transpose(all_read_value_content, 0, 1) # seqlen, BS, dim
-                    elif configs.kt_model == 'dkvmn':
-                        out = all_read_value_content
-        else:
-            with torch.no_grad():
-                out, hidden = lstm(padded_lstm_ins.cuda(), (hidden_h, hidden_c)) # shape = T*B*D
+                    out = all_read_value_content
         ks = out[timesteps, list(range(out.shape[1])), :] # extract the hidden states --> shape=B*D
     
     else:
         assert(configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay'])
-        if configs.combine_method == 'no_decay':
-            ks = []
-            for b in range(len(timesteps)):
-                code_embs = torch.tensor(lstm_inputs[students[b]]['code_emb'][timesteps[b]]).cuda()
-                ks.append( code_embs )
-            return ks, None
-        # compute the exponential decay factors
-        if 'exp_' in configs.combine_method:
-            exp_weights = []
-            for b in range(len(timesteps)):
-                w = torch.exp(-torch.arange(timesteps[b]+1).flip(dims=[0]).float())
-                w = w / w.sum() # normalize
-                exp_weights.append(w) # exponential decay for each student, up til t
-        if 'kc_' in configs.combine_method:
-            kc_weights = []
-            prompt_kc = [lstm_inputs[s]['prompt_kc'] for s in students]
-            for b in range(len(timesteps)):
-                # set_trace()
-                w = torch.tensor([jaccard_score(prompt_kc[b][i], prompt_kc[b][timesteps[b]+1]) for i in range(timesteps[b]+1)])
-                w = w / w.sum() if w.sum() != 0 else torch.zeros_like(w) # normalize; do not normalize 0
-                kc_weights.append(w)
-
-        # compute the weights
-        if configs.combine_method == 'exp_decay':
-            weights = exp_weights
-        elif configs.combine_method == 'kc_sim_decay':
-            weights = kc_weights
-        elif configs.combine_method == 'exp_kc_decay':
-            weights = [exp_weights[i] * kc_weights[i] for i in range(len(exp_weights))]
-            weights = [w / w.sum() if w.sum() != 0 else torch.zeros_like(w) for w in weights] # normalize
-        elif configs.combine_method == 'no_decay':
-            weights = []
-            for b in range(len(timesteps)):
-                w = torch.tensor([0 for i in range(timesteps[b]+1)])
-                w[timesteps[b]] = 1
-                weights.append(w)
-        weights = [w.unsqueeze(0).to(torch.float32).cuda() for w in weights]
-        # compute the weighted knowledge code embeddings, until the current time step
-        ks = []
-        for b in range(len(timesteps)):
-            code_embs = torch.tensor(np.stack(lstm_inputs[students[b]]['code_emb'][:timesteps[b]+1])).cuda()
-            ks.append( torch.mm(weights[b], code_embs) )
-        ks = torch.cat(ks)
+        if code_bank is None:
+            # only the histories of this batch
+            code_bank = CodeEmbeddingBank({s: lstm_inputs[s] for s in set(students)})
+        ks = decay_knowledge_states(code_bank, lstm_inputs, students, timesteps, configs)
         out = None
         
     return ks, out
 
 
+def combine_knowledge_states(generator_input_wte, prompt_id_lens, ks, linear, weight, configs, kc_vecs=None):
+    '''
+    add the knowledge states into the prompt positions of the generator input embeddings, for the whole 
+    batch at once: positions < prompt_id_lens[i] of row i get ks[i] combined by configs.combine_method, 
+    the EOS and the code are left as they are; linear runs once over the batch
+    @param generator_input_wte: B*T*D token embeddings
+    @param ks: B*D knowledge states (or a list of D, see no_decay)
+    @param kc_vecs: B*K knowledge components, concatenated to ks for 'linear' with use_kc
+    @return: B*T*D combined embeddings
+    '''
+    if isinstance(ks, list):
+        ks = torch.stack(ks)
+    prompt_id_lens = torch.as_tensor(prompt_id_lens, device=generator_input_wte.device)
+    positions = torch.arange(generator_input_wte.shape[1], device=generator_input_wte.device)
+    prompt_mask = (positions.unsqueeze(0) < prompt_id_lens.unsqueeze(1)).unsqueeze(-1) # B*T*1
+    
+    if configs.combine_method == 'add':
+        combined = generator_input_wte + configs.combine_weight * ks.unsqueeze(1)
+    elif configs.combine_method == 'average':
+        combined = (generator_input_wte + configs.combine_weight * ks.unsqueeze(1)) / 2
+    elif configs.combine_method == 'weight':
+        combined = generator_input_wte + (weight * ks).unsqueeze(1)
+    elif configs.combine_method == 'linear':
+        if configs.use_kc:
+            assert(kc_vecs is not None)
+            combined = generator_input_wte + linear( torch.cat((ks, kc_vecs.to(ks.device)), dim=-1) ).unsqueeze(1)
+        else:
+            combined = generator_input_wte + linear(ks).unsqueeze(1)
+    elif configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
+        combined = generator_input_wte + linear(ks).unsqueeze(1)
+    else:
+        return generator_input_wte
+    return torch.where(prompt_mask, combined, generator_input_wte)
+
+
 def assemble_generator_input(model, lstm, linear, weight, configs,
-                             generator_input_ids, prompt_id_lens, lstm_inputs, students, timesteps, kc_vecs=None):
+                             generator_input_ids, prompt_id_lens, lstm_inputs, students, timesteps, kc_vecs=None, ks_table=None, code_bank=None):
     '''
     linear: linear transform the knowledge state before adding in with the generator input
     weight: weight to apply to the knowledge state before adding in with the generator input
+    ks_table: optional KnowledgeStateTable of the frozen lstm
+    code_bank: optional CodeEmbeddingBank, for the combine methods without the lstm
     '''
     
     # compute generator embeddings for the batch
     generator_input_wte = model.transformer.wte(generator_input_ids.cuda()) # shape=B*T*D
     
     # get knowledge states
-    ks, out = get_knowledge_states_for_generator(lstm, lstm_inputs, students, timesteps, configs)
+    ks, out = get_knowledge_states_for_generator(lstm, lstm_inputs, students, timesteps, configs, ks_table=ks_table, code_bank=code_bank)
     
     # combine kc with generator input
-    for i in range(len(students)):
-        if configs.combine_method == 'add':
-            generator_input_wte[i, :prompt_id_lens[i]] += configs.combine_weight * ks[i]
-        elif configs.combine_method == 'average':
-            generator_input_wte[i, :prompt_id_lens[i]] = (generator_input_wte[i, :prompt_id_lens[i]] + \
-                                                        configs.combine_weight * ks[i]) / 2
-        elif configs.combine_method == 'weight':
-            generator_input_wte[i, :prompt_id_lens[i]] += weight * ks[i]
-        elif configs.combine_method == 'linear':
-            if configs.use_kc:
-                assert(kc_vecs[i] is not None)
-                generator_input_wte[i, :prompt_id_lens[i]] += linear( torch.cat((ks[i], kc_vecs[i].cuda()), dim=-1) )
-            else:
-                generator_input_wte[i, :prompt_id_lens[i]] += linear(ks[i])      
-        elif configs.combine_method in ['exp_decay', 'kc_sim_decay', 'exp_kc_decay', 'no_decay']:
-            generator_input_wte[i, :prompt_id_lens[i]] += linear(ks[i])  
+    generator_input_wte = combine_knowledge_states(generator_input_wte, prompt_id_lens, ks, linear, weight, configs, kc_vecs=kc_vecs)
     
     # testing 
     if configs.testing: